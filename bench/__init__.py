@@ -0,0 +1,3 @@
+""" Offline benchmarks for pinner.  JSON-RPC, IPFS and Redis are replaced with
+    local fakes so runs are repeatable without any outside services.
+"""
@@ -0,0 +1,101 @@
+""" Run the benchmarks and write the results as JSON
+
+    python -m bench [-s SCENARIO ...] [-o results.json]
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import subprocess
+from pinner.pinner import BATCH_SIZE
+from .scenarios import SCENARIOS, STALL_TIMEOUT
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pinner against local fakes.')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                        dest="scenarios",
+                        help="Scenario to run.  Can be given more than once.  Default: all")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="File to write the JSON results to.  Default: stdout")
+    parser.add_argument('--logs', type=int, default=100000,
+                        help="Logs to decode. Default: 100000")
+    parser.add_argument('--blocks', type=int, default=2000,
+                        help="Blocks for the end to end run. Default: 2000")
+    parser.add_argument('--logs-per-block', type=int, default=10, dest="logs_per_block",
+                        help="Logs in each block. Default: 10")
+    parser.add_argument('--rpc-latency', type=float, default=0.01, dest="rpc_latency",
+                        help="Seconds added to each JSON-RPC request. Default: 0.01")
+    parser.add_argument('--ipfs-delay', type=float, default=0.005, dest="ipfs_delay",
+                        help="Seconds each pin takes. Default: 0.005")
+    parser.add_argument('--failure-rate', type=float, default=0, dest="failure_rate",
+                        help="Fraction of pins that time out. Default: 0")
+    parser.add_argument('-c', '--concurrency', type=int, default=20,
+                        help="Concurrent pins. Default: 20")
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, dest="batch_size",
+                        help="Hashes in each pin request. Default: {}".format(BATCH_SIZE))
+    parser.add_argument('-t', '--stall-timeout', type=int, default=STALL_TIMEOUT,
+                        dest="stall_timeout",
+                        help="Seconds a failed pin stalls for. Default: {}".format(STALL_TIMEOUT))
+    parser.add_argument('-Q', '--queue', type=str, default=None,
+                        help="Queue for the end to end run, e.g. sqlite:/tmp/bench.db. "
+                             "Default: redis")
+    parser.add_argument('--pins', type=int, default=100000,
+                        help="Pins on the node at startup. Default: 100000")
+    parser.add_argument('-d', '--debug', action='store_true', default=False,
+                        help="Show debug output")
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        # The pinner's loggers are chatty
+        logging.disable(logging.WARNING)
+
+    params = {
+        'decode': {'logs': args.logs, 'logs_per_block': args.logs_per_block},
+        'end_to_end': {
+            'blocks': args.blocks,
+            'logs_per_block': args.logs_per_block,
+            'rpc_latency': args.rpc_latency,
+            'ipfs_delay': args.ipfs_delay,
+            'failure_rate': args.failure_rate,
+            'concurrency': args.concurrency,
+            'queue': args.queue,
+            'batch_size': args.batch_size,
+            'stall_timeout': args.stall_timeout,
+        },
+        'startup': {'pins': args.pins},
+    }
+
+    report = {
+        'timestamp': int(time.time()),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scenarios': {},
+    }
+    for name in args.scenarios or sorted(SCENARIOS):
+        print("Running {}...".format(name), file=sys.stderr)
+        report['scenarios'][name] = SCENARIOS[name](**params[name])
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
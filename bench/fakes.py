@@ -0,0 +1,308 @@
+""" Local stand-ins for the JSON-RPC provider, the IPFS API and Redis """
+import json
+import time
+import random
+import hashlib
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+import base58
+from eth_utils import keccak, encode_hex
+from pinner.ipfs import to_str
+
+CONTRACT_ADDRESS = '0x7448d96e5348d149deadbeef760948998b9db3d5'
+EVENT_ABI = {
+    "anonymous": False,
+    "inputs": [
+        {"indexed": True, "name": "sender", "type": "address"},
+        {"indexed": False, "name": "contentHash", "type": "bytes32"},
+        {"indexed": False, "name": "timestamp", "type": "uint256"},
+    ],
+    "name": "Post",
+    "type": "event",
+}
+EVENT_TOPIC = encode_hex(keccak(text='Post(address,bytes32,uint256)'))
+
+
+# Blocks fetched for each pin when progress is streamed
+BLOCKS_PER_PIN = 5
+# Seconds between progress reports, as the daemon sends them
+PROGRESS_INTERVAL = 0.5
+# Seconds a failing pin stalls for when progress is streamed
+STALL_LIMIT = 60
+
+
+def contract_config(start_block=0):
+    """ Listener config for the fake contract """
+    return {
+        "address": CONTRACT_ADDRESS,
+        "events": [{"name": "Post", "hashParam": "contentHash"}],
+        "abi": [EVENT_ABI],
+        "startBlock": start_block,
+    }
+
+
+def content_hash(block, index):
+    """ Deterministic sha2-256 digest for a log """
+    return hashlib.sha256('{}:{}'.format(block, index).encode('utf-8')).hexdigest()
+
+
+def ipfs_hash(digest):
+    return to_str(base58.b58encode(bytes.fromhex('1220' + digest)))
+
+
+def make_log(block, index, address=CONTRACT_ADDRESS):
+    return {
+        "address": address,
+        "blockNumber": hex(block),
+        "blockHash": '0x%064x' % block,
+        "transactionHash": '0x%064x' % (block * 1000 + index),
+        "transactionIndex": hex(index),
+        "logIndex": hex(index),
+        "topics": [EVENT_TOPIC, '0x%064x' % (0xbeef + index)],
+        "data": '0x' + content_hash(block, index) + '%064x' % (1500000000 + block),
+        "removed": False,
+    }
+
+
+def make_logs(count, logs_per_block=10, first_block=0):
+    return [make_log(first_block + i // logs_per_block, i % logs_per_block)
+            for i in range(count)]
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """ HTTP server run on a background thread on a free local port """
+    handler = None
+
+    def __init__(self):
+        self.server = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        fake = self
+
+        class Handler(self.handler):
+            server_fake = fake
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_stream(self, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def send_chunk(self, body):
+        """ Write a chunk of a chunked response.  An empty body ends it. """
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.wfile.write('{:x}\r\n'.format(len(body)).encode('ascii') + body + b'\r\n')
+        self.wfile.flush()
+
+
+class RPCHandler(Handler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        chain = self.server_fake
+        if chain.latency:
+            time.sleep(chain.latency)
+        if isinstance(request, list):
+            response = [chain.handle(x) for x in request]
+        else:
+            response = chain.handle(request)
+        self.reply(200, json.dumps(response))
+
+
+class FakeChain(FakeServer):
+    """ JSON-RPC provider serving a chain where every block has the same
+        number of logs from the fake contract.  latency is added to every
+        HTTP request.
+    """
+    handler = RPCHandler
+
+    def __init__(self, head=10000, logs_per_block=10, latency=0):
+        super(FakeChain, self).__init__()
+        self.head = head
+        self.logs_per_block = logs_per_block
+        self.latency = latency
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.port)
+
+    def block_number(self, value):
+        if value == 'latest':
+            return self.head
+        return min(int(value, 16), self.head)
+
+    def get_logs(self, log_filter):
+        from_block = self.block_number(log_filter.get('fromBlock', 'latest'))
+        to_block = self.block_number(log_filter.get('toBlock', 'latest'))
+        addresses = log_filter.get('address') or [CONTRACT_ADDRESS]
+        if not isinstance(addresses, list):
+            addresses = [addresses]
+        logs = []
+        for address in addresses:
+            for block in range(from_block, to_block + 1):
+                for index in range(self.logs_per_block):
+                    logs.append(make_log(block, index, address))
+        return logs
+
+    def handle(self, request):
+        method = request['method']
+        params = request.get('params') or []
+        if method == 'eth_blockNumber':
+            result = hex(self.head)
+        elif method == 'eth_getLogs':
+            result = self.get_logs(params[0])
+        elif method == 'eth_getBlockByNumber':
+            number = self.block_number(params[0])
+            result = {'number': hex(number), 'hash': '0x%064x' % number}
+        elif method == 'eth_newBlockFilter':
+            result = '0x1'
+        elif method == 'eth_getFilterChanges':
+            result = []
+        else:
+            return {'jsonrpc': '2.0', 'id': request.get('id'),
+                    'error': {'code': -32601, 'message': 'Method not found'}}
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+
+class IPFSHandler(Handler):
+    def do_POST(self):
+        node = self.server_fake
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        path = url.path.replace('/api/v0/', '')
+
+        if path == 'id':
+            self.reply(200, json.dumps({'ID': 'QmFake'}))
+        elif path == 'pin/add':
+            hashes = params['arg']
+            # Like the daemon, the hashes are fetched one after another
+            failed = [random.random() < node.failure_rate for x in hashes]
+            if params.get('progress') == ['true']:
+                self.pin_progress(hashes, failed)
+                return
+            if node.delay:
+                time.sleep(node.delay * len(hashes))
+            if any(failed):
+                self.reply(500, json.dumps({'Message': 'context deadline exceeded',
+                                            'Type': 'error'}))
+                return
+            with node.lock:
+                node.pinned.update(hashes)
+            self.reply(200, json.dumps({'Pins': hashes}))
+        elif path == 'pin/ls':
+            lines = ''.join(json.dumps({'Cid': x, 'Type': 'recursive'}) + '\n'
+                            for x in node.pin_list())
+            self.reply(200, lines, content_type='application/x-ndjson')
+        else:
+            self.reply(404, json.dumps({'Message': 'Not found', 'Type': 'error'}))
+
+
+    def pin_progress(self, hashes, failed):
+        """ Stream progress while fetching BLOCKS_PER_PIN blocks for each hash.
+            A failed hash stops making progress until the client hangs up or
+            STALL_LIMIT seconds pass.
+        """
+        node = self.server_fake
+        self.start_stream()
+        blocks = 0
+        last_report = time.time()
+        try:
+            for ipfs_hash, fail in zip(hashes, failed):
+                stalled_until = time.time() + STALL_LIMIT if fail else 0
+                fetched = 0
+                while fetched < BLOCKS_PER_PIN or time.time() < stalled_until:
+                    time.sleep(node.delay / BLOCKS_PER_PIN)
+                    if not fail:
+                        fetched += 1
+                        blocks += 1
+                    if time.time() - last_report >= PROGRESS_INTERVAL:
+                        last_report = time.time()
+                        self.send_chunk(json.dumps({'Progress': blocks}) + '\n')
+                if fail:
+                    self.send_chunk(json.dumps({'Message': 'context deadline exceeded',
+                                                'Type': 'error'}) + '\n')
+                    self.send_chunk('')
+                    return
+            with node.lock:
+                node.pinned.update(hashes)
+            self.send_chunk(json.dumps({'Progress': blocks}) + '\n')
+            self.send_chunk(json.dumps({'Pins': hashes}) + '\n')
+            self.send_chunk('')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on the pin
+            self.close_connection = True
+
+
+class FakeIPFS(FakeServer):
+    """ IPFS API with pin/add, pin/ls and id.  Each pin takes delay seconds
+        and fails with a timeout at failure_rate, or stalls if progress is
+        being streamed.  The node starts out with preloaded pins.
+    """
+    handler = IPFSHandler
+
+    def __init__(self, delay=0, failure_rate=0, preloaded=0):
+        super(FakeIPFS, self).__init__()
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.preloaded = preloaded
+        self.pinned = set()
+        self.lock = threading.Lock()
+
+    def pin_list(self):
+        for i in range(self.preloaded):
+            yield ipfs_hash(content_hash('preloaded', i))
+        with self.lock:
+            pinned = list(self.pinned)
+        for pinned_hash in pinned:
+            yield pinned_hash
+
+
+def use_fake_redis():
+    """ Point every redis.Redis() the pinner makes at one in-memory server.
+        Returns the server.
+    """
+    import redis
+    import fakeredis
+
+    server = fakeredis.FakeServer()
+
+    def connect(*args, **kwargs):
+        return fakeredis.FakeRedis(server=server)
+
+    redis.Redis = connect
+    return server
@@ -0,0 +1,155 @@
+""" Benchmark scenarios.  Each takes its parameters as keyword arguments and
+    returns a dict of measurements.
+"""
+import os
+import time
+import logging
+import threading
+from pinner.decoder import EventDecoder
+from pinner.pipeline import DecodePipeline
+from pinner.dedup import BloomFilter
+from pinner.listener import ContractListener
+from pinner.pinner import Pinner, BATCH_SIZE
+from .fakes import FakeChain, FakeIPFS, EVENT_ABI, contract_config, make_logs, use_fake_redis
+
+log = logging.getLogger('bench.scenarios')
+
+# Seconds between checks for the pinner having drained the queue
+DRAIN_INTERVAL = 0.05
+# Seconds failed pins stall for before the pinner gives up on them.  Shorter
+# than the pinner's default to keep runs with failures quick.
+STALL_TIMEOUT = 2
+
+
+def rate(count, seconds):
+    if seconds <= 0:
+        return None
+    return round(count / seconds, 1)
+
+
+def decode(logs=100000, logs_per_block=10, processes=None):
+    """ Decode throughput of EventDecoder on its own and through the
+        DecodePipeline, in-process and across a process pool
+    """
+    processes = processes or os.cpu_count()
+    batch = make_logs(logs, logs_per_block)
+    contract = contract_config()
+    results = {'logs': logs, 'processes': processes}
+
+    decoder = EventDecoder([EVENT_ABI])
+    start = time.time()
+    decoded = sum(1 for x in decoder.process_logs(batch))
+    elapsed = time.time() - start
+    assert decoded == logs, "Decoded {} of {} logs".format(decoded, logs)
+    results['decoder_seconds'] = round(elapsed, 4)
+    results['decoder_logs_per_second'] = rate(logs, elapsed)
+
+    pipeline = DecodePipeline(processes=1)
+    start = time.time()
+    hashes = sum(1 for x in pipeline.hashes(contract, batch))
+    elapsed = time.time() - start
+    results['pipeline_seconds'] = round(elapsed, 4)
+    results['pipeline_logs_per_second'] = rate(hashes, elapsed)
+
+    pipeline = DecodePipeline(processes=processes, min_parallel=0)
+    try:
+        # Leave process start up out of the measurement
+        sum(1 for x in pipeline.hashes(contract, batch[:pipeline.chunk_size * processes]))
+        start = time.time()
+        hashes = sum(1 for x in pipeline.hashes(contract, batch))
+        elapsed = time.time() - start
+    finally:
+        pipeline.shutdown()
+    results['parallel_seconds'] = round(elapsed, 4)
+    results['parallel_logs_per_second'] = rate(hashes, elapsed)
+
+    return results
+
+
+def end_to_end(blocks=2000, logs_per_block=10, rpc_latency=0.01, ipfs_delay=0.005,
+               failure_rate=0, concurrency=20, queue=None, batch_size=BATCH_SIZE,
+               stall_timeout=STALL_TIMEOUT, timeout=600):
+    """ Hashes per second from JSON-RPC logs through ContractListener onto the
+        queue, then through a Pinner onto a fake IPFS node.  queue is a queue
+        URL as given to the pinner's --queue.  Failed pins stall for
+        stall_timeout seconds.
+    """
+    use_fake_redis()
+    chain = FakeChain(head=blocks - 1, logs_per_block=logs_per_block, latency=rpc_latency).start()
+    ipfs = FakeIPFS(delay=ipfs_delay, failure_rate=failure_rate).start()
+    expected = blocks * logs_per_block
+    results = {
+        'blocks': blocks,
+        'logs_per_block': logs_per_block,
+        'rpc_latency': rpc_latency,
+        'ipfs_delay': ipfs_delay,
+        'failure_rate': failure_rate,
+        'concurrency': concurrency,
+        'queue': queue or 'redis',
+        'batch_size': batch_size,
+        'stall_timeout': stall_timeout,
+    }
+
+    try:
+        dedup = BloomFilter('bench', capacity=expected * 2)
+        listener = ContractListener(contract_config(), chain.url, dedup=dedup,
+                                    pipeline=DecodePipeline(processes=1), queue_url=queue)
+        start = time.time()
+        found = listener.scan()
+        listen_seconds = time.time() - start
+        results['hashes'] = found
+        results['listener_seconds'] = round(listen_seconds, 4)
+        results['listener_hashes_per_second'] = rate(found, listen_seconds)
+
+        pinner = Pinner('127.0.0.1', ipfs.port, concurrency=concurrency, queue_url=queue,
+                        batch_size=batch_size, stall_timeout=stall_timeout)
+        start = time.time()
+        thread = threading.Thread(target=pinner.process_jobs, daemon=True)
+        thread.start()
+        # Done once nothing is waiting or in flight.  Failed pins are left
+        # scheduled for retry.
+        while time.time() - start < timeout:
+            if pinner.queue.qsize() == 0 and pinner.queue.in_flight() == 0:
+                break
+            time.sleep(DRAIN_INTERVAL)
+        pin_seconds = time.time() - start
+    finally:
+        chain.stop()
+        ipfs.stop()
+
+    results['pinned'] = len(ipfs.pinned)
+    results['failed'] = pinner.queue.retry_size()
+    results['pinner_seconds'] = round(pin_seconds, 4)
+    results['pinner_hashes_per_second'] = rate(found, pin_seconds)
+    results['total_seconds'] = round(listen_seconds + pin_seconds, 4)
+    results['hashes_per_second'] = rate(found, listen_seconds + pin_seconds)
+    return results
+
+
+def startup(pins=100000):
+    """ Time for a Pinner to start against a node with a large pin set, which
+        is mostly loading the pin index
+    """
+    use_fake_redis()
+    ipfs = FakeIPFS(preloaded=pins).start()
+    try:
+        start = time.time()
+        pinner = Pinner('127.0.0.1', ipfs.port)
+        elapsed = time.time() - start
+    finally:
+        ipfs.stop()
+
+    indexed = len(pinner.cluster.nodes[0].pins)
+    assert indexed == pins, "Indexed {} of {} pins".format(indexed, pins)
+    return {
+        'pins': pins,
+        'startup_seconds': round(elapsed, 4),
+        'pins_per_second': rate(pins, elapsed),
+    }
+
+
+SCENARIOS = {
+    'decode': decode,
+    'end_to_end': end_to_end,
+    'startup': startup,
+}
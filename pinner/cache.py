@@ -0,0 +1,42 @@
+""" Small in-process caches """
+import threading
+from collections import OrderedDict
+
+
+class LRUSet(object):
+    """ Set holding at most maxsize items, forgetting the least recently used
+        first.  Safe to share between threads.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        with self.lock:
+            if item not in self.items:
+                return False
+            self.items.move_to_end(item)
+            return True
+
+    def add_many(self, items):
+        with self.lock:
+            for item in items:
+                self.items[item] = True
+                self.items.move_to_end(item)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def add(self, item):
+        self.add_many([item])
+
+    def discard(self, item):
+        with self.lock:
+            self.items.pop(item, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
@@ -0,0 +1,33 @@
+""" Durable record of how far each contract has been scanned """
+import redis
+
+
+class Checkpoints(object):
+    """ Last block scanned for each contract and event set, kept in a Redis hash
+        so listeners resume where they left off
+    """
+    def __init__(self, name='blocks', namespace='checkpoints', **redis_kwargs):
+        self._db = redis.Redis(**redis_kwargs)
+        self.key = '%s:%s' % (namespace, name)
+
+    @staticmethod
+    def field(address, events):
+        return '%s:%s' % (address.lower(), ','.join(sorted(set(events))))
+
+    def get(self, address, events):
+        """ Get the last scanned block number, or None if never scanned """
+        block = self._db.hget(self.key, self.field(address, events))
+        if block is None:
+            return None
+        return int(block)
+
+    def set(self, address, events, block_number):
+        self._db.hset(self.key, self.field(address, events), int(block_number))
+
+    def set_many(self, contracts, block_number):
+        """ Set the same block for many (address, events) pairs at once """
+        if not contracts:
+            return
+        self._db.hset(self.key, mapping={
+            self.field(address, events): int(block_number) for address, events in contracts
+        })
@@ -4,9 +4,18 @@ import logging
 import argparse
 import json
 import multiprocessing as mp
+from urllib.parse import urlparse
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from .pinner import start_pinner
-from .listener import process_contract
+from .pinner import start_pinner, CONCURRENCY, BATCH_SIZE, STALL_TIMEOUT
+from .listener import process_contract, process_contracts, BACKFILL_CHUNK_SIZE, BACKFILL_CONCURRENCY, \
+    BACKFILL_BATCH_SIZE
+from .jsonrpc import JSONRPCClient
+from .limits import TokenBucket
+from .pipeline import DecodePipeline
+from .notify import BlockNotifier
+from .dedup import BloomFilter, DEFAULT_CAPACITY, DEFAULT_ERROR_RATE
+from .metrics import start_server
+from .queue import LANES, LANE_WEIGHTS
 
 log = logging.getLogger('pinner.cli')
 log.setLevel(logging.DEBUG)
@@ -17,18 +26,62 @@ def workers_alive(workers):
             return False
     return True
 
+def lane_weights(value):
+    """ Parse realtime,backfill,retry lane weights, e.g. 8,2,1 """
+    try:
+        weights = [int(x) for x in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Weights must be integers")
+    if len(weights) != len(LANES) or min(weights) < 1:
+        raise argparse.ArgumentTypeError("Expected {} positive weights for {}".format(
+            len(LANES), ','.join(LANES)))
+    return dict(zip(LANES, weights))
+
+DEFAULT_WEIGHTS = ','.join(str(LANE_WEIGHTS[x]) for x in LANES)
+
 def pinner(args=None):
     if not args:
         parser = argparse.ArgumentParser(description='Pin hashes for Ethereum smart contract events.')
         parser.add_argument('ipfs_host', metavar='IPFS_HOST', type=str, 
                             default='127.0.0.1',
-                            help='The hostname or IP of the IPFS node. Default: 127.0.0.1')
+                            help='The hostname or IP of the IPFS node, or a comma separated list of '
+                                 'host[:port] to replicate pins across. Default: 127.0.0.1')
         parser.add_argument('-p', '--ipfs-port', type=int, default=5001, 
                             dest="ipfs_port",
                             help="The IPFS API port to connect to")
         parser.add_argument('-w', '--workers', type=int, default=3, 
                             dest="workers",
                             help="Total pinner workers to start. Default: 3")
+        parser.add_argument('-c', '--concurrency', type=int, default=CONCURRENCY,
+                            dest="concurrency",
+                            help="Concurrent pins per worker. Default: {}".format(CONCURRENCY))
+        parser.add_argument('-n', '--replicas', type=int, default=1,
+                            dest="replicas",
+                            help="IPFS nodes to pin each hash to. Default: 1")
+        parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE,
+                            dest="batch_size",
+                            help="Hashes to send to a node in one pin request. "
+                                 "Default: {}".format(BATCH_SIZE))
+        parser.add_argument('-t', '--stall-timeout', type=int, default=STALL_TIMEOUT,
+                            dest="stall_timeout",
+                            help="Seconds a pin can go without fetching a block before it "
+                                 "fails. Default: {}".format(STALL_TIMEOUT))
+        parser.add_argument('-R', '--ipfs-rate', type=float, default=None,
+                            dest="ipfs_rate",
+                            help="Most pins per second to each IPFS node across all "
+                                 "workers. Default: no limit")
+        parser.add_argument('-l', '--lane-weights', type=lane_weights, default=None,
+                            dest="weights",
+                            help="Share of pins for the realtime,backfill,retry queue lanes. "
+                                 "Default: {}".format(DEFAULT_WEIGHTS))
+        parser.add_argument('-M', '--metrics-port', type=int, default=None,
+                            dest="metrics_port",
+                            help="Serve Prometheus metrics from worker N on this port + N")
+        parser.add_argument('-Q', '--queue', type=str, default=None,
+                            dest="queue",
+                            help="Queue to use: redis, or sqlite:PATH to share a SQLite "
+                                 "database between processes on one host.  Redis is still "
+                                 "needed for everything but the queue. Default: redis")
         parser.add_argument('-r', '--redis-host', type=str, default="127.0.0.1", 
                             dest="redis_host",
                             help="Redis hostname or IP address. Default: 127.0.0.1")
@@ -49,7 +102,9 @@ def pinner(args=None):
 
     workers = []
     for i in range(0, args.workers):
-        process = mp.Process(target=start_pinner, args=(args.ipfs_host, args.ipfs_port, args.redis_host, args.redis_port))
+        # Each worker process serves its own metrics
+        metrics_port = args.metrics_port + i + 1 if args.metrics_port else None
+        process = mp.Process(target=start_pinner, args=(args.ipfs_host, args.ipfs_port, args.redis_host, args.redis_port, args.concurrency, args.weights, args.replicas, metrics_port, args.queue, args.batch_size, args.stall_timeout, args.ipfs_rate))
         process.start()
         workers.append(process)
 
@@ -69,6 +124,25 @@ def listener(args=None):
         parser = argparse.ArgumentParser(description='Listen for IPFS hashes in Ethereum smart contract events.')
         parser.add_argument('CONFIG', metavar='JSON', type=str, 
                             help='A JSON Configuration file')
+        parser.add_argument('-r', '--redis-host', type=str, default="127.0.0.1", 
+                            dest="redis_host",
+                            help="Redis hostname or IP address. Default: 127.0.0.1")
+        parser.add_argument('-q', '--redis-port', type=int, default=6379, 
+                            dest="redis_port",
+                            help="Redis port. Default: 6379")
+        parser.add_argument('-m', '--combined', action='store_true', default=False,
+                            help="Watch all contracts with a single log filter")
+        parser.add_argument('-M', '--metrics-port', type=int, default=None,
+                            dest="metrics_port",
+                            help="Serve Prometheus metrics on this port")
+        parser.add_argument('-Q', '--queue', type=str, default=None,
+                            dest="queue",
+                            help="Queue to use: redis, or sqlite:PATH to share a SQLite "
+                                 "database between processes on one host.  Redis is still "
+                                 "needed for everything but the queue. Default: redis")
+        parser.add_argument('--reset-dedup', action='store_true', default=False,
+                            dest="reset_dedup",
+                            help="Forget every hash the listener has queued before starting")
         parser.add_argument('-d', '--debug', action='store_true', default=False,
                             help="Show debug output")
 
@@ -85,14 +159,76 @@ def listener(args=None):
     with open(args.CONFIG) as config_file:
         json_config = json.load(config_file)
 
+    if args.metrics_port:
+        start_server(args.metrics_port)
+
+    # The queue can also be set in the config, but the command line wins
+    queue_url = args.queue or json_config.get('queue')
+
     threads = []
 
+    # Skip hashes that have already been queued by any listener.  Set "dedup"
+    # to false in the config to disable.
+    dedup = None
+    dedup_config = json_config.get('dedup', {})
+    if dedup_config is not False:
+        dedup = BloomFilter('hashes',
+                            capacity=dedup_config.get('capacity', DEFAULT_CAPACITY),
+                            error_rate=dedup_config.get('errorRate', DEFAULT_ERROR_RATE),
+                            host=args.redis_host, port=args.redis_port)
+        if args.reset_dedup:
+            log.warning("Clearing the dedup filter.")
+            dedup.clear()
+
     log.info("Connecting to Ethereum provider {}".format(json_config['jsonrpc']))
+    # Calls per second to the provider, shared by every listener using the
+    # same Redis.  Set "rateLimit" to {"rate": N, "burst": M} to enable.
+    limiter = None
+    rate_limit = json_config.get('rateLimit')
+    if rate_limit:
+        limiter = TokenBucket('rpc:{}'.format(urlparse(json_config['jsonrpc']).netloc),
+                              rate_limit['rate'], rate_limit.get('burst'),
+                              host=args.redis_host, port=args.redis_port)
+    combined = args.combined or json_config.get('combined')
+    if combined:
+        listeners = 1
+        concurrency = json_config.get('backfillConcurrency', BACKFILL_CONCURRENCY)
+    else:
+        listeners = len(json_config['contracts'])
+        concurrency = max(x.get('backfillConcurrency', BACKFILL_CONCURRENCY)
+                          for x in json_config['contracts'])
+    # One pooled client for every listener thread.  The backfills share a
+    # limit of the largest backfillConcurrency on top of the listeners' own
+    # requests, plus one for the notifier.
+    client = JSONRPCClient(json_config['jsonrpc'], pool_size=listeners + concurrency + 1,
+                           limiter=limiter)
 
-    with ThreadPoolExecutor(max_workers=len(json_config)) as pooler:
-        for contract in json_config['contracts']:
-            log.debug("Starting up process for %s", contract['address'])
-            threads.append(pooler.submit(process_contract, contract, json_config['jsonrpc'], args.redis_host, args.redis_port))
+    # Large batches of logs are decoded across this many processes.  Defaults
+    # to one per CPU.
+    pipeline = DecodePipeline(processes=json_config.get('decodeProcesses'))
+
+    # Wake the listeners up on new blocks rather than polling on a timer.  Set
+    # "ws" to a WebSocket endpoint to use eth_subscribe, or "notify" to false
+    # to only poll.
+    notifier = None
+    if json_config.get('notify', True) is not False:
+        notifier = BlockNotifier(client, json_config.get('ws')).start()
+
+    if combined:
+        log.info("Watching %s contracts with a single log filter", len(json_config['contracts']))
+        with ThreadPoolExecutor(max_workers=1) as pooler:
+            threads.append(pooler.submit(process_contracts, json_config['contracts'],
+                                         json_config['jsonrpc'], args.redis_host, args.redis_port, dedup,
+                                         json_config.get('backfillChunkSize', BACKFILL_CHUNK_SIZE),
+                                         json_config.get('backfillConcurrency', BACKFILL_CONCURRENCY),
+                                         json_config.get('backfillBatchSize', BACKFILL_BATCH_SIZE),
+                                         notifier, client, pipeline,
+                                         json_config.get('confirmations', 0), queue_url))
+    else:
+        with ThreadPoolExecutor(max_workers=len(json_config['contracts'])) as pooler:
+            for contract in json_config['contracts']:
+                log.debug("Starting up process for %s", contract['address'])
+                threads.append(pooler.submit(process_contract, contract, json_config['jsonrpc'], args.redis_host, args.redis_port, dedup, notifier, client, pipeline, json_config.get('confirmations', 0), queue_url))
 
     for future in as_completed(threads):
         try:
@@ -111,7 +247,8 @@ def start_all():
                         help='A JSON Configuration file')
     parser.add_argument('ipfs_host', metavar='IPFS_HOST', type=str, 
                         default='127.0.0.1',
-                        help='The hostname or IP of the IPFS node. Default: 127.0.0.1')
+                        help='The hostname or IP of the IPFS node, or a comma separated list of '
+                             'host[:port] to replicate pins across. Default: 127.0.0.1')
     parser.add_argument('-d', '--debug', action='store_true', default=False,
                         help="Show debug output")
     parser.add_argument('-p', '--ipfs-port', type=int, default=5001, 
@@ -120,12 +257,48 @@ def start_all():
     parser.add_argument('-w', '--workers', type=int, default=3, 
                         dest="workers",
                         help="Total pinner workers to start. Default: 3")
+    parser.add_argument('-c', '--concurrency', type=int, default=CONCURRENCY,
+                        dest="concurrency",
+                        help="Concurrent pins per worker. Default: {}".format(CONCURRENCY))
+    parser.add_argument('-n', '--replicas', type=int, default=1,
+                        dest="replicas",
+                        help="IPFS nodes to pin each hash to. Default: 1")
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE,
+                        dest="batch_size",
+                        help="Hashes to send to a node in one pin request. "
+                             "Default: {}".format(BATCH_SIZE))
+    parser.add_argument('-t', '--stall-timeout', type=int, default=STALL_TIMEOUT,
+                        dest="stall_timeout",
+                        help="Seconds a pin can go without fetching a block before it "
+                             "fails. Default: {}".format(STALL_TIMEOUT))
+    parser.add_argument('-R', '--ipfs-rate', type=float, default=None,
+                        dest="ipfs_rate",
+                        help="Most pins per second to each IPFS node across all "
+                             "workers. Default: no limit")
+    parser.add_argument('-l', '--lane-weights', type=lane_weights, default=None,
+                        dest="weights",
+                        help="Share of pins for the realtime,backfill,retry queue lanes. "
+                             "Default: {}".format(DEFAULT_WEIGHTS))
     parser.add_argument('-r', '--redis-host', type=str, default="127.0.0.1", 
                         dest="redis_host",
                         help="Redis hostname or IP address. Default: 127.0.0.1")
     parser.add_argument('-q', '--redis-port', type=int, default=6379, 
                         dest="redis_port",
                         help="Redis port. Default: 6379")
+    parser.add_argument('-m', '--combined', action='store_true', default=False,
+                        help="Watch all contracts with a single log filter")
+    parser.add_argument('-M', '--metrics-port', type=int, default=None,
+                        dest="metrics_port",
+                        help="Serve Prometheus metrics from the listener on this port and "
+                             "from pinner worker N on this port + N")
+    parser.add_argument('-Q', '--queue', type=str, default=None,
+                        dest="queue",
+                        help="Queue to use: redis, or sqlite:PATH to share a SQLite "
+                             "database between processes on one host.  Redis is still "
+                             "needed for everything but the queue. Default: redis")
+    parser.add_argument('--reset-dedup', action='store_true', default=False,
+                        dest="reset_dedup",
+                        help="Forget every hash the listener has queued before starting")
 
     args = parser.parse_args()
 
@@ -0,0 +1,147 @@
+""" Spreads pins over a set of IPFS nodes, keeping each hash on a number of
+    them
+"""
+import time
+import logging
+import threading
+from .ipfs import IPFSClient, IPFSError, IPFSUnavailable
+from .pinset import PinIndex
+from .limits import TokenBucket
+
+log = logging.getLogger('pinner.cluster')
+log.setLevel(logging.DEBUG)
+
+DEFAULT_PORT = 5001
+# Weight of the newest sample in a node's pin latency average
+LATENCY_DECAY = 0.2
+# Seconds a pin is assumed to take on a node we haven't timed yet
+DEFAULT_LATENCY = 1.0
+# Seconds a node is left alone after it couldn't be reached
+FAILURE_COOLDOWN = 30
+
+
+def parse_nodes(value, default_port=DEFAULT_PORT):
+    """ Parse a comma separated list of host[:port] into (host, port) pairs """
+    nodes = []
+    for node in value.split(','):
+        node = node.strip()
+        if not node:
+            continue
+        if ':' in node:
+            host, port = node.rsplit(':', 1)
+            nodes.append((host, int(port)))
+        else:
+            nodes.append((node, default_port))
+    return nodes
+
+
+class IPFSNode(object):
+    """ One IPFS API endpoint, the index of what's pinned on it, and how busy
+        it is from this worker's point of view
+    """
+    def __init__(self, host, port=DEFAULT_PORT, pool_size=10, redis_host='localhost',
+                 redis_port=6379, rate=None):
+        self.host = host
+        self.port = port
+        self.name = '{}:{}'.format(host, port)
+        self.client = IPFSClient(host, port, pool_size=pool_size)
+        self.pins = PinIndex(self.name, host=redis_host, port=redis_port)
+        # Pins per second to this node from every worker
+        self.limiter = None
+        if rate:
+            self.limiter = TokenBucket('ipfs:{}'.format(self.name), rate, host=redis_host,
+                                       port=redis_port)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency = DEFAULT_LATENCY
+        self.down_until = 0
+
+    def __repr__(self):
+        return '<IPFSNode {}>'.format(self.name)
+
+    def is_up(self):
+        return time.time() >= self.down_until
+
+    def mark_down(self, cooldown=FAILURE_COOLDOWN):
+        self.down_until = time.time() + cooldown
+
+    def load(self):
+        """ Roughly how long a new pin would take to finish here """
+        return self.latency * (self.in_flight + 1)
+
+    def pin(self, ipfs_hashes, timeout=None, stall_timeout=None, progress=None):
+        """ Pin one or more hashes in one request and record them in the node's
+            index.  Nodes that can't be reached are skipped for a while.
+        """
+        if isinstance(ipfs_hashes, (str, bytes)):
+            ipfs_hashes = [ipfs_hashes]
+        if self.limiter is not None:
+            self.limiter.acquire(len(ipfs_hashes))
+        with self.lock:
+            self.in_flight += len(ipfs_hashes)
+        start = time.time()
+        try:
+            pinned = self.client.pin_add(ipfs_hashes, timeout=timeout,
+                                         stall_timeout=stall_timeout, progress=progress)
+        except IPFSUnavailable:
+            self.mark_down()
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= len(ipfs_hashes)
+
+        # Timeouts are usually content nobody is providing, so only successful
+        # pins say anything about the node's speed
+        elapsed = (time.time() - start) / len(ipfs_hashes)
+        with self.lock:
+            self.latency += LATENCY_DECAY * (elapsed - self.latency)
+        self.pins.add_many(ipfs_hashes)
+        return pinned
+
+
+class Cluster(object):
+    """ The IPFS nodes pins are spread over.  Each hash is pinned to
+        `replicas` of them, picking the least loaded nodes that don't have it.
+    """
+    def __init__(self, nodes, replicas=1):
+        self.nodes = nodes
+        self.replicas = replicas
+        if self.replicas > len(self.nodes):
+            log.warning("Only %s IPFS nodes for a replication factor of %s", len(self.nodes),
+                        self.replicas)
+            self.replicas = len(self.nodes)
+
+    def connect(self, retries=5, delay=3):
+        """ Wait for the nodes to come up.  Nodes that don't are skipped until
+            they can be reached, but at least one has to.
+        """
+        pending = list(self.nodes)
+        for attempt in range(retries + 1):
+            for node in list(pending):
+                try:
+                    node.client.id()
+                    pending.remove(node)
+                except IPFSError:
+                    log.debug("Error connecting to IPFS node %s", node.name)
+            if not pending:
+                return
+            if attempt < retries:
+                log.debug("Retrying connection to %s IPFS nodes in %ss...", len(pending), delay)
+                time.sleep(delay)
+
+        if len(pending) == len(self.nodes):
+            raise IPFSUnavailable("Could not connect to any IPFS node")
+        for node in pending:
+            log.error("Could not connect to IPFS node %s.  Skipping it for now.", node.name)
+            node.mark_down()
+
+    def holders(self, hashes):
+        """ The nodes each hash is pinned on, per the pin indexes """
+        pinned = [node.pins.contains_many(hashes) for node in self.nodes]
+        return [[node for node, has in zip(self.nodes, column) if has]
+                for column in zip(*pinned)]
+
+    def choose(self, exclude, count):
+        """ Pick up to count of the least loaded nodes that are up """
+        candidates = [x for x in self.nodes if x not in exclude and x.is_up()]
+        return sorted(candidates, key=lambda x: x.load())[:count]
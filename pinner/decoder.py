@@ -8,6 +8,38 @@ from eth_utils import keccak, add_0x_prefix, decode_hex, encode_hex
 log = logging.getLogger('pinner.decoder')
 
 UINT_REGEX = re.compile(r'uint[0-9]{1,3}')
+# Hex characters in one ABI word
+WORD = 64
+
+def decode_word_bytes32(word):
+    return '0x' + word
+
+def decode_word_uint(word):
+    return int(word, 16)
+
+def decode_topic_bytes32(topic):
+    return topic.lower() if topic.startswith('0x') else '0x' + topic.lower()
+
+def word_decoder(abi_type):
+    """ Decoder for a static type we can slice straight out of the hex data,
+        or None if it needs eth_abi.  Arrays like uint256[2] take more than one
+        word, so the whole type has to match.
+    """
+    if abi_type == 'bytes32':
+        return decode_word_bytes32
+    if UINT_REGEX.fullmatch(abi_type):
+        return decode_word_uint
+    return None
+
+def topic_decoder(abi_type):
+    """ Decoder for an indexed value """
+    if UINT_REGEX.match(abi_type):
+        return decode_word_uint
+    if abi_type == 'bytes32':
+        return decode_topic_bytes32
+    if abi_type in ['address', 'string']:
+        return decode_hex
+    return None
 
 class EventDecoder(object):
     """ Decode events using a provided ABI and log topics """
@@ -17,6 +49,9 @@ class EventDecoder(object):
         self.sig_lookup = {}
         self.name_lookup = {}
         self.inputs = {}
+        # Decoding plan for each topic, keyed by both the str and bytes topic
+        # so logs never need to be re-encoded
+        self.plans = {}
 
         self.process_abi(abi)
         if logs:
@@ -53,67 +88,98 @@ class EventDecoder(object):
                     "data_types": inputs_list
                 }
 
-    def decode_event(self, topic, indexed, data):
+                plan = self.compile_plan(part['name'], names_list, indexed_list, inputs_list)
+                self.plans[sig_hash] = plan
+                self.plans[sig_hash.decode('utf-8')] = plan
+
+    def compile_plan(self, name, names, indexed_types, data_types):
+        """ Work out ahead of time how to decode each field of an event.  If
+            every data field is a static type we can slice out of the hex
+            data, eth_abi is skipped entirely.
+        """
+        total_indexed = len(indexed_types)
+        indexed = [(names[i], topic_decoder(indexed_types[i]))
+                   for i in range(0, total_indexed)]
+
+        data_names = names[total_indexed:]
+        word_decoders = [word_decoder(x) for x in data_types]
+        fast = None
+        if None not in word_decoders:
+            fast = [(data_names[i], 2 + i * WORD, 2 + (i + 1) * WORD, word_decoders[i])
+                    for i in range(0, len(data_types))]
+
+        return {
+            "name": name,
+            "indexed": indexed,
+            "fast": fast,
+            "data_size": 2 + len(data_types) * WORD,
+            "data_names": data_names,
+            "data_types": data_types,
+        }
+
+    def decode_plan(self, plan, indexed, data):
+        """ Decode an event's fields using a compiled plan """
         result = {}
 
-        total_indexed = len(indexed)
-        for i in range(0,total_indexed):
-            this_type = self.inputs[topic]['indexed_types'][i]
-            if UINT_REGEX.match(this_type):
-                result[self.inputs[topic]['names'][i]] = int(indexed[i], 16)
-            elif this_type in ['address', 'string', 'bytes32']:
-                if this_type == 'bytes32':
-                    log.debug("Decoding bytes32 value!!!!!!!!!!!!! %s", indexed[i])
-                    result[self.inputs[topic]['names'][i]] = encode_hex(indexed[i].encode('utf-8'))
-                else:
-                    log.debug("Decoding bytes32 value %s", indexed[i])
-                    result[self.inputs[topic]['names'][i]] = decode_hex(indexed[i])
+        for (name, decoder), value in zip(plan['indexed'], indexed):
+            if decoder is None:
+                log.warning("No handler for type")
             else:
-                log.warn("No handler for type")
-
-
-        data_vals = decode_abi(self.inputs[topic]['data_types'], decode_hex(data))
-        for i in range(0, len(self.inputs[topic]['data_types'])):
-            this_type = self.inputs[topic]['data_types'][i]
-            if this_type == 'bytes32':
-                result[self.inputs[topic]['names'][total_indexed+i]] = encode_hex(data_vals[i])
+                result[name] = decoder(value)
+
+        fast = plan['fast']
+        if fast is not None and len(data) >= plan['data_size'] and data.startswith('0x'):
+            for name, start, end, decoder in fast:
+                result[name] = decoder(data[start:end])
+            return result
+
+        data_types = plan['data_types']
+        data_vals = decode_abi(data_types, decode_hex(data))
+        for i in range(0, len(data_types)):
+            if data_types[i] == 'bytes32':
+                result[plan['data_names'][i]] = encode_hex(data_vals[i])
             else:
-                result[self.inputs[topic]['names'][total_indexed+i]] = data_vals[i]
+                result[plan['data_names'][i]] = data_vals[i]
 
         return result
 
-    def process_event(self, evnt): 
-        """ Parse and process an event """
-        topic = evnt['topics'][0]
-        topic_cutoff = len(evnt['topics']) - 1
+    def decode_event(self, topic, indexed, data):
         if type(topic) != bytes:
             topic = topic.encode('utf-8')
-        
-        log.debug("Processing transaction %s topic %s", evnt['transactionHash'], topic)
+        return self.decode_plan(self.plans[topic], indexed, data)
 
-        if topic in self.topics:
-            decoded_event = self.decode_event(topic, evnt['topics'][1:], evnt['data'])
-            event = {
-                "name": self.name_lookup[topic],
-                "args": decoded_event,
-            }
-            
-            log.debug("Decoded event: %s", event)
+    def process_event(self, evnt): 
+        """ Parse and process an event """
+        plan = self.plans.get(evnt['topics'][0])
+        if plan is None:
+            return None
 
-            return event
+        event = {
+            "name": plan['name'],
+            "args": self.decode_plan(plan, evnt['topics'][1:], evnt['data']),
+        }
 
-        return None
+        return event
 
     def process_logs(self, logs):
-        """ Go through each of the provided logs and process the events """
+        """ Go through each of the provided logs and process the events in one
+            pass
+        """
         vals = []
+        plans = self.plans
+        decode_plan = self.decode_plan
         for evnt in logs:
             try:
-                processed = self.process_event(evnt)
-                if processed:
-                    vals.append(processed)
+                topics = evnt['topics']
+                if not topics:
+                    continue
+                plan = plans.get(topics[0])
+                if plan is not None:
+                    vals.append({
+                        "name": plan['name'],
+                        "args": decode_plan(plan, topics[1:], evnt['data']),
+                    })
             except Exception:
                 log.exception("Unhandled error processing event")
 
         return vals
-
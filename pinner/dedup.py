@@ -0,0 +1,114 @@
+""" Enqueue-time deduplication of hashes """
+import math
+import hashlib
+import redis
+from .cache import LRUSet
+
+DEFAULT_CAPACITY = 50000000
+DEFAULT_ERROR_RATE = 0.001
+# Redis strings top out at 512MB
+MAX_BITS = 2 ** 32
+# Recently added hashes each process remembers
+RECENT_CACHE_SIZE = 100000
+
+
+class BloomFilter(object):
+    """ Bloom filter kept in a Redis bitmap so every listener shares it.  Its
+        size is fixed by the capacity and false-positive rate it's created
+        with, so memory use doesn't grow with the number of hashes seen.  A
+        false positive means a hash is treated as already queued.  Nothing is
+        removed short of clear(), so hashes this process added recently are
+        remembered and not sent again.
+    """
+    def __init__(self, name, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE,
+                 namespace='bloom', cache_size=RECENT_CACHE_SIZE, **redis_kwargs):
+        self._db = redis.Redis(**redis_kwargs)
+        self.recent = LRUSet(cache_size)
+        self.key = '%s:%s' % (namespace, name)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = min(MAX_BITS, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+
+    def offsets(self, item):
+        """ Bit offsets for an item using double hashing over one SHA-256 """
+        if type(item) != bytes:
+            item = item.encode('utf-8')
+        digest = hashlib.sha256(item).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(0, self.hashes)]
+
+    def __contains__(self, item):
+        return self.contains_many([item])[0]
+
+    def contains_many(self, items):
+        """ Check membership for many items in one round trip """
+        found = [item in self.recent for item in items]
+        unknown = [item for item, known in zip(items, found) if not known]
+        if not unknown:
+            return found
+
+        pipe = self._db.pipeline(transaction=False)
+        for item in unknown:
+            for offset in self.offsets(item):
+                pipe.getbit(self.key, offset)
+        bits = pipe.execute()
+        present = iter([all(bits[i * self.hashes:(i + 1) * self.hashes])
+                        for i in range(0, len(unknown))])
+        return [known or next(present) for known in found]
+
+    def add(self, item):
+        """ Add an item.  Returns True if it was not already present. """
+        return self.add_many([item])[0]
+
+    def add_many(self, items):
+        """ Add items in one atomic round trip.  Returns a list of booleans,
+            True for each item that was not already present.
+        """
+        if not items:
+            return []
+
+        unseen = [x for x in items if x not in self.recent]
+        if not unseen:
+            return [False] * len(items)
+
+        pipe = self._db.pipeline(transaction=True)
+        for item in unseen:
+            for offset in self.offsets(item):
+                pipe.setbit(self.key, offset, 1)
+        previous = pipe.execute()
+        self.recent.add_many(unseen)
+
+        # SETBIT returns the old bit, so an item is new if any were unset
+        new = set()
+        for i in range(0, len(unseen)):
+            bits = previous[i * self.hashes:(i + 1) * self.hashes]
+            if not all(bits):
+                new.add(unseen[i])
+        # Only the first of any repeats in this batch counts as added
+        added = []
+        for item in items:
+            added.append(item in new)
+            new.discard(item)
+        return added
+
+    def filter_new(self, items):
+        """ Items that are not present, without repeats.  They are not added,
+            so call add_many() once they've been handled.
+        """
+        new = []
+        seen = set()
+        for item, present in zip(items, self.contains_many(items)):
+            if not present and item not in seen:
+                seen.add(item)
+                new.append(item)
+        return new
+
+    def clear(self):
+        """ Forget every item, in every process once their recent caches
+            have cycled
+        """
+        self._db.delete(self.key)
+        self.recent.clear()
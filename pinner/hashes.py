@@ -0,0 +1,174 @@
+""" Turns the content hashes found in events into CIDs to pin.  Each event can
+    say how its hash is encoded with "hashFormat":
+
+    - sha256: a bytes32 sha2-256 digest, pinned as a CIDv0 (the default)
+    - cidv1: a bytes32 sha2-256 digest, pinned as a base32 CIDv1 with the
+      event's "codec" (dag-pb unless given)
+    - multihash: a bytes value holding a whole multihash
+    - cid: a string holding a CID
+
+    Values that don't decode to a valid CID are skipped rather than queued.
+"""
+import base64
+import logging
+from functools import lru_cache
+import base58
+from eth_utils import decode_hex
+from .ipfs import to_str
+
+log = logging.getLogger('pinner.hashes')
+log.setLevel(logging.DEBUG)
+
+# Conversions remembered for each format
+CACHE_SIZE = 65536
+
+SHA2_256 = 0x12
+CODECS = {
+    'raw': 0x55,
+    'dag-pb': 0x70,
+    'dag-cbor': 0x71,
+}
+DEFAULT_FORMAT = 'sha256'
+DEFAULT_CODEC = 'dag-pb'
+
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(data, pos=0):
+    """ Returns (value, position after it) """
+    value = 0
+    shift = 0
+    while pos < len(data):
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+    raise ValueError("Truncated varint")
+
+
+def to_bytes(value):
+    """ Event values come out of the decoder as hex strings or bytes """
+    if isinstance(value, bytes):
+        return value
+    return decode_hex(value)
+
+
+def is_multihash(data):
+    try:
+        code, pos = decode_varint(data)
+        length, pos = decode_varint(data, pos)
+    except ValueError:
+        return False
+    return length > 0 and len(data) - pos == length
+
+
+def base32(data):
+    return 'b' + base64.b32encode(data).decode('ascii').lower().rstrip('=')
+
+
+def unbase32(value):
+    value = value[1:].upper()
+    return base64.b32decode(value + '=' * (-len(value) % 8))
+
+
+def is_cid(value):
+    """ Is value a CIDv0, or a CIDv1 in base32? """
+    try:
+        if value.startswith('Qm') and len(value) == 46:
+            data = base58.b58decode(value)
+            return len(data) == 34 and data[:2] == b'\x12\x20'
+        if value.startswith('b'):
+            data = unbase32(value)
+            if len(data) < 2 or data[0] != 1:
+                return False
+            codec, pos = decode_varint(data, 1)
+            return is_multihash(data[pos:])
+    except ValueError:
+        return False
+    return False
+
+
+def sha256_digest(value):
+    """ The 32 byte digest in value, or None if it isn't one """
+    try:
+        digest = to_bytes(value)
+    except (ValueError, TypeError):
+        return None
+    if len(digest) != 32 or not any(digest):
+        return None
+    return digest
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def sha256_cidv0(value):
+    digest = sha256_digest(value)
+    if digest is None:
+        return None
+    return to_str(base58.b58encode(b'\x12\x20' + digest))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def sha256_cidv1(value, codec=CODECS[DEFAULT_CODEC]):
+    digest = sha256_digest(value)
+    if digest is None:
+        return None
+    return base32(b'\x01' + encode_varint(codec) + b'\x12\x20' + digest)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def multihash_cid(value):
+    """ CIDv0 for sha2-256 multihashes, base32 dag-pb CIDv1 for the rest """
+    try:
+        data = to_bytes(value)
+    except (ValueError, TypeError):
+        return None
+    if not is_multihash(data):
+        return None
+    if data[:2] == b'\x12\x20':
+        return to_str(base58.b58encode(data))
+    return base32(b'\x01' + encode_varint(CODECS[DEFAULT_CODEC]) + data)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def string_cid(value):
+    if isinstance(value, bytes):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    value = value.strip()
+    if not is_cid(value):
+        return None
+    return value
+
+
+def normalizer(event):
+    """ Function turning an event's hash value into a CID, or None if it isn't
+        a valid one, for an event from a contract's config
+    """
+    hash_format = event.get('hashFormat', DEFAULT_FORMAT)
+    if hash_format == 'sha256':
+        return sha256_cidv0
+    if hash_format == 'cidv1':
+        codec_name = event.get('codec', DEFAULT_CODEC)
+        if codec_name not in CODECS:
+            raise ValueError("Unknown codec {} for event {}".format(codec_name, event['name']))
+        codec = CODECS[codec_name]
+        return lambda value: sha256_cidv1(value, codec)
+    if hash_format == 'multihash':
+        return multihash_cid
+    if hash_format == 'cid':
+        return string_cid
+    raise ValueError("Unknown hashFormat {} for event {}".format(hash_format, event['name']))
@@ -0,0 +1,201 @@
+""" Minimal IPFS HTTP API client that reuses pooled keep-alive connections """
+import json
+import time
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+
+log = logging.getLogger('pinner.ipfs')
+log.setLevel(logging.DEBUG)
+
+# Seconds allowed to establish a TCP connection to the IPFS API
+CONNECT_TIMEOUT = 5
+# Extra seconds we wait past the daemon-side timeout before giving up locally
+TIMEOUT_GRACE = 5
+
+
+class IPFSError(Exception):
+    """ The IPFS API could not be reached or returned an error """
+    pass
+
+
+class IPFSTimeout(IPFSError):
+    """ The IPFS node did not finish an operation in time """
+    pass
+
+
+class IPFSStalled(IPFSTimeout):
+    """ The IPFS node stopped making progress fetching content to pin """
+    pass
+
+
+class IPFSUnavailable(IPFSError):
+    """ The IPFS API could not be connected to """
+    pass
+
+
+def to_str(value):
+    """ Hashes come off of Redis as bytes """
+    if type(value) == bytes:
+        return value.decode('utf-8')
+    return value
+
+
+class IPFSClient(object):
+    """ Talks to the IPFS API over a single pooled requests session """
+
+    def __init__(self, host='127.0.0.1', port=5001, pool_size=10):
+        self.host = host
+        self.port = port
+        self.base_url = 'http://{}:{}/api/v0'.format(host, port)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+
+    def request(self, path, params=None, timeout=None, stream=False, read_timeout=None):
+        """ POST to an API endpoint.  If a timeout is given, the daemon is
+            asked to cancel the operation itself once it elapses and the
+            local socket gives up shortly after.  read_timeout overrides how
+            long the socket waits for each read.
+        """
+        params = dict(params or {})
+        if timeout:
+            params['timeout'] = '{}s'.format(timeout)
+            if read_timeout is None:
+                read_timeout = timeout + TIMEOUT_GRACE
+
+        url = '{}/{}'.format(self.base_url, path)
+        try:
+            resp = self.session.post(url, params=params, stream=stream,
+                                     timeout=(CONNECT_TIMEOUT, read_timeout))
+        except requests.exceptions.ConnectionError as ex:
+            raise IPFSUnavailable(str(ex)) from ex
+        except requests.exceptions.Timeout as ex:
+            raise IPFSTimeout("Request to {} timed out".format(path)) from ex
+        except requests.exceptions.RequestException as ex:
+            raise IPFSError(str(ex)) from ex
+
+        if resp.status_code != 200:
+            try:
+                message = resp.json().get('Message', resp.text)
+            except ValueError:
+                message = resp.text
+            if 'context deadline exceeded' in message:
+                raise IPFSTimeout(message)
+            raise IPFSError(message)
+
+        return resp
+
+    def id(self):
+        """ Get the node's identity.  Useful as a connectivity check. """
+        return self.request('id', timeout=CONNECT_TIMEOUT).json()
+
+    def pin_ls(self, type='all'):
+        """ List pins on the node """
+        return self.request('pin/ls', params={'type': type}).json()
+
+    def pin_ls_stream(self, type='all'):
+        """ Iterate over the hashes pinned on the node as the daemon lists them
+            rather than loading the whole pin set at once
+        """
+        resp = self.request('pin/ls', params={'type': type, 'stream': 'true'},
+                            stream=True)
+        try:
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError as ex:
+                    raise IPFSError("Unexpected response from IPFS") from ex
+
+                if 'Cid' in obj:
+                    yield obj['Cid']
+                elif 'Keys' in obj:
+                    # Daemons without --stream support send one big object
+                    for key in obj['Keys']:
+                        yield key
+                elif obj.get('Type') == 'error':
+                    raise IPFSError(obj.get('Message'))
+        finally:
+            resp.close()
+
+    def pin_add(self, ipfs_hashes, timeout=None, stall_timeout=None, progress=None):
+        """ Recursively pin one or more hashes in one request, returning the
+            list of pinned hashes.  The daemon pins them one after another and
+            fails the whole request if any of them fails.
+
+            With a stall_timeout the daemon streams the number of blocks it
+            has fetched, and the pin is abandoned once that stops growing for
+            stall_timeout seconds, however long the whole pin has taken.
+            progress is called with the block count each time it grows.
+        """
+        if isinstance(ipfs_hashes, (str, bytes)):
+            ipfs_hashes = [ipfs_hashes]
+        ipfs_hashes = [to_str(x) for x in ipfs_hashes]
+        params = {'arg': ipfs_hashes}
+
+        if stall_timeout is None:
+            resp = self.request('pin/add', params=params, timeout=timeout)
+            try:
+                pinned = resp.json()
+            except ValueError as ex:
+                raise IPFSError("Unexpected response from IPFS") from ex
+        else:
+            params['progress'] = 'true'
+            # The daemon reports progress every half second, so a silent
+            # socket means the daemon itself is stuck
+            resp = self.request('pin/add', params=params, timeout=timeout, stream=True,
+                                read_timeout=stall_timeout + TIMEOUT_GRACE)
+            try:
+                pinned = self.pin_progress(resp, stall_timeout, progress)
+            finally:
+                # Closing the connection early cancels the pin on the daemon
+                resp.close()
+
+        if not pinned or len(pinned.get('Pins') or []) < 1:
+            raise IPFSError("IPFS did not report any pins for {}".format(
+                           ', '.join(ipfs_hashes)))
+
+        return pinned['Pins']
+
+    def pin_progress(self, resp, stall_timeout, progress=None):
+        """ Follow a streaming pin/add until it reports its pins """
+        blocks = 0
+        last_change = time.time()
+        try:
+            for line in resp.iter_lines(chunk_size=None):
+                if not line:
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError as ex:
+                    raise IPFSError("Unexpected response from IPFS") from ex
+
+                if obj.get('Type') == 'error':
+                    message = obj.get('Message')
+                    if 'context deadline exceeded' in (message or ''):
+                        raise IPFSTimeout(message)
+                    raise IPFSError(message)
+                if 'Pins' in obj:
+                    return obj
+                if obj.get('Progress', 0) > blocks:
+                    blocks = obj['Progress']
+                    last_change = time.time()
+                    if progress is not None:
+                        progress(blocks)
+                elif time.time() - last_change > stall_timeout:
+                    raise IPFSStalled("No progress for {}s after {} blocks".format(
+                                      stall_timeout, blocks))
+        except requests.exceptions.ConnectionError as ex:
+            # requests reports read timeouts on a stream as connection errors
+            if ex.args and isinstance(ex.args[0], ReadTimeoutError):
+                raise IPFSStalled("IPFS stopped responding after {} blocks".format(
+                                  blocks)) from ex
+            raise IPFSUnavailable(str(ex)) from ex
+        except requests.exceptions.RequestException as ex:
+            raise IPFSError(str(ex)) from ex
+
+        # Errors after the headers were sent come as a trailer we can't read
+        raise IPFSError("IPFS ended the pin without reporting any pins")
@@ -0,0 +1,185 @@
+""" Shared JSON-RPC client with pooled keep-alive connections, timeouts,
+    retries and request batching
+"""
+import time
+import random
+import logging
+import threading
+import itertools
+import requests
+from requests.adapters import HTTPAdapter
+from . import metrics
+
+log = logging.getLogger('pinner.jsonrpc')
+log.setLevel(logging.DEBUG)
+
+# Seconds to wait for a connection and then for a response
+CONNECT_TIMEOUT = 5
+TIMEOUT = 30
+# Retries for connection errors and overloaded servers
+RETRIES = 3
+# Seconds before the first retry.  Doubles each time, with jitter.
+RETRY_BACKOFF = 0.5
+# HTTP statuses worth retrying
+RETRY_STATUSES = [429, 502, 503, 504]
+POOL_SIZE = 20
+# Provider errors meaning a request returned too many logs
+TOO_MANY_RESULTS = ['returned more than', 'too many results', 'response size',
+                    'range too large', 'range is too', 'block range', 'max results']
+# Provider errors meaning we're making too many requests
+RATE_LIMITED = ['rate limit', 'rate exceeded', 'request rate', 'too many requests',
+                'request count', 'requests per']
+# Code some providers use for both of the above
+LIMIT_EXCEEDED = -32005
+
+
+class RPCError(Exception):
+    """ The JSON-RPC server returned an error or could not be reached """
+    def __init__(self, message, code=None):
+        super(RPCError, self).__init__(message)
+        self.code = code
+
+    def rate_limited(self):
+        """ Did the provider reject the request because we're calling too
+            often?
+        """
+        if self.code == 429:
+            return True
+        message = str(self).lower()
+        return any(x in message for x in RATE_LIMITED)
+
+    def too_many_results(self):
+        """ Did the provider reject the request because of its size?  Only
+            these are worth splitting.  Timeouts and everything else are
+            retried as they are.
+        """
+        if self.rate_limited():
+            return False
+        message = str(self).lower()
+        return self.code == LIMIT_EXCEEDED or any(x in message for x in TOO_MANY_RESULTS)
+
+
+class JSONRPCClient(object):
+    """ JSON-RPC over HTTP using one pooled requests session.  It's safe to
+        share a client between threads.  If given a limiter (a TokenBucket),
+        each call takes a token from it, including each call in a batch.
+    """
+    def __init__(self, server, timeout=TIMEOUT, retries=RETRIES, pool_size=POOL_SIZE,
+                 limiter=None):
+        self.server = server
+        self.timeout = timeout
+        self.retries = retries
+        self.limiter = limiter
+        self.ids = itertools.count(1)
+        self.id_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def next_id(self):
+        with self.id_lock:
+            return next(self.ids)
+
+    def payload(self, method, params):
+        return {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": self.next_id(),
+        }
+
+    def post(self, payload, timeout=None):
+        """ POST a payload, retrying connection errors and overloaded servers
+            with jittered exponential backoff.  Returns the decoded JSON.
+        """
+        log.debug(payload)
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire(len(payload) if isinstance(payload, list) else 1)
+            try:
+                resp = self.session.post(self.server, json=payload,
+                                         timeout=(CONNECT_TIMEOUT, timeout or self.timeout))
+                if resp.status_code in RETRY_STATUSES:
+                    raise RPCError("JSON-RPC server returned HTTP {}".format(resp.status_code),
+                                   code=resp.status_code)
+                return resp.json()
+            except requests.exceptions.ReadTimeout as ex:
+                # Likely a request that's too big.  Retrying won't help.
+                raise RPCError("JSON-RPC request timed out") from ex
+            except (requests.exceptions.ConnectionError, RPCError) as ex:
+                if attempt >= self.retries:
+                    if isinstance(ex, RPCError):
+                        raise
+                    raise RPCError("Error talking to JSON-RPC server: {}".format(ex)) from ex
+                delay = RETRY_BACKOFF * 2 ** attempt
+                delay = random.uniform(delay / 2, delay)
+                log.warning("JSON-RPC request failed (%s).  Retrying in %.1fs", ex, delay)
+                time.sleep(delay)
+                attempt += 1
+            except requests.exceptions.RequestException as ex:
+                raise RPCError("Error talking to JSON-RPC server: {}".format(ex)) from ex
+            except ValueError as ex:
+                raise RPCError("Unexpected response from JSON-RPC server") from ex
+
+    @staticmethod
+    def result(response):
+        """ Pull the result out of a response, raising any error """
+        if response.get('error'):
+            error = response['error']
+            raise RPCError(error.get('message', str(error)), code=error.get('code'))
+        return response.get('result')
+
+    def call(self, method, params, timeout=None):
+        """ Make a JSON-RPC call and return the result """
+        start = time.time()
+        try:
+            return self.result(self.post(self.payload(method, params), timeout=timeout))
+        except RPCError:
+            metrics.RPC_ERRORS.labels(method).inc()
+            raise
+        finally:
+            metrics.RPC_SECONDS.labels(method).observe(time.time() - start)
+
+    def batch(self, calls, timeout=None):
+        """ Make many calls in one HTTP request.  calls is a list of
+            (method, params) tuples.  Returns a list in the same order holding
+            each result, or an RPCError for calls that failed.
+        """
+        if not calls:
+            return []
+
+        payloads = [self.payload(method, params) for method, params in calls]
+        methods = set(x['method'] for x in payloads)
+        label = methods.pop() if len(methods) == 1 else 'batch'
+        start = time.time()
+        try:
+            responses = self.post(payloads, timeout=timeout)
+        except RPCError:
+            metrics.RPC_ERRORS.labels(label).inc()
+            raise
+        finally:
+            metrics.RPC_SECONDS.labels(label).observe(time.time() - start)
+        if not isinstance(responses, list):
+            # Some servers answer a batch with a single error
+            error = RPCError("Unexpected batch response from JSON-RPC server")
+            try:
+                self.result(responses)
+            except RPCError as ex:
+                error = ex
+            return [error for x in payloads]
+
+        by_id = {x.get('id'): x for x in responses}
+        results = []
+        for payload in payloads:
+            response = by_id.get(payload['id'])
+            if response is None:
+                results.append(RPCError("No response for JSON-RPC call {}".format(payload['method'])))
+                continue
+            try:
+                results.append(self.result(response))
+            except RPCError as ex:
+                results.append(ex)
+        return results
@@ -0,0 +1,149 @@
+""" Rate limits shared between processes and concurrency limits that adapt to
+    how an upstream is coping
+"""
+import time
+import logging
+import threading
+import redis
+from . import metrics
+
+log = logging.getLogger('pinner.limits')
+log.setLevel(logging.DEBUG)
+
+# Multiplier applied to a concurrency limit when an upstream struggles
+BACKOFF = 0.5
+# Seconds after cutting a concurrency limit before it can be cut again, so a
+# burst of failures from requests that were already in flight only counts once
+DECREASE_INTERVAL = 5
+
+_shared_limits = {}
+_shared_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """ Token bucket shared through Redis by every process using the same
+        name.  Tokens refill at `rate` per second up to `burst`.  The bucket is
+        kept as the time it will next be full (GCRA), so taking tokens is one
+        compare-and-set of a single key, and Redis' clock is used so that
+        workers on different hosts agree.
+    """
+    def __init__(self, name, rate, burst=None, namespace='ratelimit', **redis_kwargs):
+        self._db = redis.Redis(**redis_kwargs)
+        self.name = name
+        self.key = '%s:%s' % (namespace, name)
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(self.rate))
+        self.interval = 1.0 / self.rate
+
+    def reserve(self, tokens=1):
+        """ Take tokens, returning the seconds to wait before using them.
+            Tokens beyond what's in the bucket are borrowed from the future,
+            so callers queue up in the order they asked.
+        """
+        with self._db.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.key)
+                    seconds, micros = pipe.time()
+                    now = seconds + micros / 1000000.0
+                    full_at = max(float(pipe.get(self.key) or 0), now) + tokens * self.interval
+                    pipe.multi()
+                    pipe.set(self.key, repr(full_at), px=int((full_at - now) * 1000) + 1000)
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        return max(0.0, full_at - self.burst * self.interval - now)
+
+    def acquire(self, tokens=1):
+        """ Wait until tokens are available.  Returns the seconds waited. """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            metrics.RATE_LIMITED_SECONDS.labels(self.name).inc(wait)
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveLimit(object):
+    """ Concurrency limit adjusted AIMD-style.  It grows by one for every
+        limit's worth of requests that succeed within latency_target seconds,
+        and is cut by backoff when one fails or is slower than that.  Can be
+        used as a semaphore for the slots under the limit.
+    """
+    def __init__(self, name, limit, min_limit=1, max_limit=None, latency_target=None,
+                 backoff=BACKOFF, decrease_interval=DECREASE_INTERVAL):
+        self.name = name
+        self.value = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.decrease_interval = decrease_interval
+        self.last_decrease = 0
+        self.in_use = 0
+        self.cond = threading.Condition()
+        metrics.CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+
+    @property
+    def limit(self):
+        return max(self.min_limit, int(self.value))
+
+    def record(self, ok, latency=None):
+        """ Feed back how a request went """
+        with self.cond:
+            before = self.limit
+            slow = self.latency_target is not None and latency is not None \
+                and latency > self.latency_target
+            if ok and not slow:
+                self.value = min(self.max_limit, self.value + 1.0 / self.limit)
+            elif time.time() - self.last_decrease >= self.decrease_interval:
+                self.last_decrease = time.time()
+                self.value = max(self.min_limit, self.value * self.backoff)
+                log.info("%s %s.  Concurrency limit now %s", self.name,
+                         "slowing down" if ok else "failing", self.limit)
+            if self.limit != before:
+                metrics.CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+                self.cond.notify_all()
+
+    def acquire(self, blocking=True, timeout=None):
+        """ Take a slot, waiting up to timeout seconds for one if blocking.
+            Returns True if we got one.
+        """
+        with self.cond:
+            if not blocking:
+                if self.in_use >= self.limit:
+                    return False
+            elif not self.cond.wait_for(lambda: self.in_use < self.limit, timeout):
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.in_use -= 1
+            self.cond.notify()
+
+
+    def raise_max(self, max_limit):
+        """ Let the limit grow to max_limit if that's more than it could """
+        with self.cond:
+            if max_limit <= self.max_limit:
+                return
+            # Keep any backoff in effect
+            self.value += max_limit - self.max_limit
+            self.max_limit = max_limit
+            metrics.CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+            self.cond.notify_all()
+
+
+def shared_limit(name, limit, **kwargs):
+    """ The AdaptiveLimit for name in this process, created with the given
+        arguments on first use.  Lets everything calling the same upstream
+        back off together.  Its limit is the largest anyone asked for.
+    """
+    with _shared_lock:
+        if name not in _shared_limits:
+            _shared_limits[name] = AdaptiveLimit(name, limit, **kwargs)
+        else:
+            _shared_limits[name].raise_max(kwargs.get('max_limit') or limit)
+        return _shared_limits[name]
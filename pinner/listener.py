@@ -3,39 +3,343 @@
 """
 
 import time
-import json
 import logging
-import requests
-import base58
-from concurrent.futures import Future
-from eth_utils.hexadecimal import decode_hex
+from urllib.parse import urlparse
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from .decoder import EventDecoder
-from .pinner import QUEUE_NAME
-from .queue import RedisQueue
+from .queue import open_queue
+from .checkpoint import Checkpoints
+from .jsonrpc import JSONRPCClient, RPCError
+from .pipeline import DecodePipeline
+from .queue import PUSH_CHUNK_SIZE, LANES, REALTIME, BACKFILL
+from .reorg import ReorgTracker
+from .limits import shared_limit
+from . import metrics
 
 log = logging.getLogger('pinner.listener')
 log.setLevel(logging.DEBUG)
 
-class Event(object):
-    """ Simple event object """
-    def __init__(self, name, param):
-        self.name = name
-        self.param = param
+# Seconds between polls for new logs.  Without a block subscription this
+# shrinks toward MIN_POLL_INTERVAL while hashes are turning up and grows
+# toward MAX_POLL_INTERVAL while they aren't.
+POLL_INTERVAL = 15
+MIN_POLL_INTERVAL = 3
+MAX_POLL_INTERVAL = 60
+# Blocks requested per eth_getLogs call during a backfill.  This shrinks on
+# its own when the provider complains about the result size.
+BACKFILL_CHUNK_SIZE = 10000
+# Most eth_getLogs calls in flight at once during a backfill.  Fewer are made
+# while the provider is failing or slower than BACKFILL_LATENCY_TARGET seconds.
+BACKFILL_CONCURRENCY = 4
+BACKFILL_LATENCY_TARGET = 10
+# Chunks fetched per JSON-RPC batch request during a backfill
+BACKFILL_BATCH_SIZE = 4
+# Times a range is retried on unexpected errors before the backfill stops
+BACKFILL_RETRIES = 5
 
-class ContractListener(object):
+class Backfill(object):
+    """ Scans a block range for a listener in chunks, several at a time.  The
+        listener provides get_logs_many(), handle_logs() and checkpoint().
+        Chunks are halved when the provider reports too many results and
+        slowly grow back after that.  The number of requests in flight backs
+        off while the provider is failing or slow, and that limit is shared
+        by every backfill using the same provider.  Hashes are queued as each
+        chunk finishes and the checkpoint follows the highest contiguous block
+        scanned.
+    """
+    def __init__(self, listener, chunk_size=BACKFILL_CHUNK_SIZE,
+                 concurrency=BACKFILL_CONCURRENCY, batch_size=BACKFILL_BATCH_SIZE,
+                 latency_target=BACKFILL_LATENCY_TARGET):
+        self.listener = listener
+        self.max_chunk_size = chunk_size
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        provider = urlparse(listener.client.server).netloc or listener.client.server
+        self.limit = shared_limit('eth_getLogs:%s' % provider, concurrency,
+                                  latency_target=latency_target)
+
+    def has_work(self, cursor, end, retry):
+        return bool(retry) or cursor <= end
+
+    def run(self, start, end):
+        """ Scan start through end inclusive.  Returns the number of hashes
+            found.
+        """
+        found = 0
+        cursor = start
+        retry = deque()
+        attempts = {}
+        done = {}
+        scanned = start - 1
+        futures = {}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while futures or self.has_work(cursor, end, retry):
+                # Keep the pool full, split or failed ranges first.  Each
+                # request carries a batch of ranges and needs a slot under
+                # the provider's limit.  We only wait for one when none of
+                # our own requests are in flight.
+                while len(futures) < self.concurrency and self.has_work(cursor, end, retry):
+                    if not self.limit.acquire(blocking=not futures):
+                        break
+                    ranges = []
+                    while len(ranges) < self.batch_size and self.has_work(cursor, end, retry):
+                        if retry:
+                            ranges.append(retry.popleft())
+                        else:
+                            ranges.append((cursor, min(end, cursor + self.chunk_size - 1)))
+                            cursor = ranges[-1][1] + 1
+                    future = pool.submit(self.listener.get_logs_many, ranges)
+                    future.add_done_callback(lambda x: self.limit.release())
+                    futures[future] = (ranges, time.time())
+
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    ranges, started = futures.pop(future)
+                    try:
+                        results = future.result()
+                    except RPCError as ex:
+                        results = [ex for x in ranges]
+                    # Ranges that were too big get split and say nothing
+                    # about the provider's load.  Timeouts, rate limits and
+                    # other errors count against it and are retried.
+                    oversized = [isinstance(x, RPCError) and x.too_many_results()
+                                 for x in results]
+                    failed = any(isinstance(x, RPCError) and not too_big
+                                 for x, too_big in zip(results, oversized))
+                    self.limit.record(not failed, time.time() - started)
+
+                    for (from_block, to_block), logs, too_big in zip(ranges, results, oversized):
+                        if isinstance(logs, RPCError):
+                            ex = logs
+                            if too_big and to_block > from_block:
+                                middle = (from_block + to_block) // 2
+                                retry.appendleft((middle + 1, to_block))
+                                retry.appendleft((from_block, middle))
+                                self.chunk_size = max(1, min(self.chunk_size, (to_block - from_block + 1) // 2))
+                                log.info("Too many results for blocks %s-%s. Chunk size now %s",
+                                         from_block, to_block, self.chunk_size)
+                                continue
+
+                            attempts[from_block] = attempts.get(from_block, 0) + 1
+                            if attempts[from_block] > BACKFILL_RETRIES:
+                                log.error("Giving up on blocks %s-%s: %s", from_block, to_block, ex)
+                                # Let the running requests finish, but don't
+                                # start new ones.  We'll pick up from the
+                                # checkpoint on the next poll.
+                                cursor = end + 1
+                                retry.clear()
+                                continue
+                            log.warning("Error fetching blocks %s-%s, retrying: %s", from_block,
+                                        to_block, ex)
+                            retry.append((from_block, to_block))
+                            continue
+
+                        chunk_found = self.listener.handle_logs(logs)
+                        found += chunk_found
+                        log.info("Total IPFS Hashes found in blocks %s-%s: %s", from_block,
+                                 to_block, chunk_found)
+                        self.chunk_size = min(self.max_chunk_size, self.chunk_size + self.chunk_size // 10 + 1)
+
+                        done[from_block] = to_block
+                        while scanned + 1 in done:
+                            scanned = done.pop(scanned + 1)
+                        if scanned >= start:
+                            self.listener.checkpoint(scanned)
+
+        return found
+
+class BaseListener(object):
+    """ Polling loop shared by the listeners.  Subclasses provide
+        block_number, queue, backfill, reorg, log_filter(), handle_logs(),
+        checkpoint(), rewind() and report_progress().
+    """
+    client = None
+    notifier = None
+    running = True
+    interval = POLL_INTERVAL
+    generation = 0
+    # Blocks to wait behind the head before scanning
+    confirmations = 0
+
+    def rpc(self, method, params):
+        """ Make a JSON-RPC call and return the result """
+        return self.client.call(method, params)
+
+    def get_logs(self, from_block, to_block):
+        """ Get our logs for a block range """
+        return self.rpc('eth_getLogs', [self.log_filter(from_block, to_block)])
+
+    def get_logs_many(self, ranges):
+        """ Get our logs for many block ranges in one batch request.  Returns
+            the logs or an RPCError for each range.
+        """
+        return self.client.batch([('eth_getLogs', [self.log_filter(*x)]) for x in ranges])
+
+    def get_head(self):
+        """ Latest block number, from the block subscription if we have one """
+        if self.notifier is not None and self.notifier.subscribed and self.notifier.head is not None:
+            return self.notifier.head
+        return int(self.rpc('eth_blockNumber', []), 16)
+
+    def get_block_hash(self, number):
+        block = self.rpc('eth_getBlockByNumber', [hex(number), False])
+        if not block:
+            return None
+        return block['hash']
+
+    def get_block_hashes(self, numbers):
+        """ Look up many block hashes in one batch request """
+        blocks = self.client.batch([('eth_getBlockByNumber', [hex(x), False]) for x in numbers])
+        for block in blocks:
+            if isinstance(block, RPCError):
+                raise block
+        return [x['hash'] if x else None for x in blocks]
+
+    def check_reorg(self):
+        """ Make sure the last blocks we scanned are still on the chain.  If
+            they aren't, drop pending hashes from the orphaned blocks and rewind
+            to the fork so it gets scanned again.  Returns True on a reorg.
+            Blocks the provider doesn't know about, as happens behind a load
+            balancer with a lagging node, leave it to the next scan.
+        """
+        recorded = self.reorg.recorded()
+        if not recorded:
+            return False
+
+        newest, newest_hash = recorded[0]
+        chain_hash = self.get_block_hash(newest)
+        if chain_hash is None:
+            log.debug("Provider doesn't have block %s.  Checking for a reorg next scan.", newest)
+            return False
+        if chain_hash == newest_hash:
+            return False
+
+        # Find the newest block we scanned that's still on the chain
+        fork = self.reorg.oldest() - 1
+        older = recorded[1:]
+        chain_hashes = self.get_block_hashes([number for number, block_hash in older])
+        for (number, block_hash), chain_hash in zip(older, chain_hashes):
+            if chain_hash is None:
+                log.debug("Provider doesn't have block %s.  Checking for a reorg next scan.",
+                          number)
+                return False
+            if chain_hash == block_hash:
+                fork = number
+                break
+        else:
+            log.error("Reorg is deeper than the %s blocks we track", self.reorg.window)
+
+        log.warning("Chain reorg detected.  Rewinding from block %s to %s", newest, fork)
+        metrics.REORGS.inc()
+        orphaned = self.reorg.rewind(fork)
+        if orphaned:
+            dropped = self.queue.remove_many(orphaned)
+            log.warning("Dropped %s pending hashes from orphaned blocks", dropped)
+        self.rewind(fork)
+        return True
+
+    def scan(self):
+        """ Scan everything we haven't up to the confirmed head.  Returns the
+            number of hashes found.
+        """
+        head = self.get_head()
+        self.reorg.set_head(head)
+        self.check_reorg()
+
+        start = int(self.block_number, 16)
+        end = head - self.confirmations
+        if end < start:
+            self.report_progress(head)
+            return 0
+
+        # Get the hashes of the blocks near the head before scanning so a
+        # reorg during the scan gets noticed next time around
+        tracked = list(range(max(start, self.reorg.track_from), end + 1))
+        block_hashes = self.get_block_hashes(tracked)
+
+        log.debug("Scanning blocks %s-%s", start, end)
+        found = self.backfill.run(start, end)
+
+        if int(self.block_number, 16) > end:
+            for number, block_hash in zip(tracked, block_hashes):
+                self.reorg.record_block(number, block_hash)
+
+        self.report_progress(head)
+        return found
+
+    def wait_for_block(self, found):
+        """ Wait for the next block notification, or poll on an interval that
+            adapts to whether the last scan found anything
+        """
+        if found:
+            self.interval = MIN_POLL_INTERVAL
+        else:
+            self.interval = min(MAX_POLL_INTERVAL, self.interval * 2)
+
+        if self.notifier is None:
+            time.sleep(self.interval)
+        elif self.notifier.subscribed:
+            self.generation = self.notifier.wait(self.generation, MAX_POLL_INTERVAL)
+        else:
+            self.generation = self.notifier.wait(self.generation, self.interval)
+
+    def process_events(self):
+        """ Processes the events and pins when a new event comes in """
+        while self.running:
+            found = 0
+            try:
+                found = self.scan()
+            except RPCError as ex:
+                log.error("JSON-RPC error: %s", ex)
+
+            self.wait_for_block(found)
+
+
+class ContractListener(BaseListener):
     """ ContractListener listens for events from a contract and submits pin 
         requests when needed
     """
-    def __init__(self, contract, jsonrpc_server, redis_host='localhost', redis_port=6379):
+    def __init__(self, contract, jsonrpc_server, redis_host='localhost', redis_port=6379,
+                 dedup=None, queue=None, checkpoints=None, notifier=None, client=None,
+                 pipeline=None, confirmations=0, reorg=None, queue_url=None):
         self.contract = contract
         self.server = jsonrpc_server
+        self.client = client
+        if self.client is None:
+            self.client = JSONRPCClient(jsonrpc_server)
+        # Decodes logs into hashes.  Shared by all listeners in a process so
+        # they use one process pool.
+        self.pipeline = pipeline
+        if self.pipeline is None:
+            self.pipeline = DecodePipeline(processes=1)
+        # BlockNotifier shared by all listeners, if we have one
+        self.notifier = notifier
         self.future = Future()
         self.running = True
         self.decoder = EventDecoder(contract['abi'])
-        self.queue = None
-        self.backlog = []
+        self.queue = queue
+        self.checkpoints = checkpoints
 
-        self.queue = RedisQueue('hashes', host=redis_host, port=redis_port)
+        if self.queue is None:
+            self.queue = open_queue(queue_url, 'hashes', redis_host=redis_host,
+                                    redis_port=redis_port)
+        if self.checkpoints is None:
+            self.checkpoints = Checkpoints(host=redis_host, port=redis_port)
+        # Filter of every hash ever queued, shared by all listeners
+        self.dedup = dedup
+        self.confirmations = self.contract.get('confirmations', confirmations)
+        # Queue lane for hashes from new blocks.  Historical hashes always go
+        # on the backfill lane.
+        self.lane = self.contract.get('priority', REALTIME)
+        if self.lane not in LANES:
+            raise ValueError("Unknown priority {} for contract {}".format(
+                self.lane, self.contract['address']))
+        self.reorg = reorg
+        if self.reorg is None:
+            self.reorg = ReorgTracker()
 
         self.events = [x['name'] for x in self.contract['events']]
         self.event_param = {}
@@ -43,90 +347,273 @@ class ContractListener(object):
             self.events.append(evt['name'])
             self.event_param[evt['name']] = evt['hashParam']
 
+        # Only ask the provider for the events we track
+        self.topics = [x.decode('utf-8') for x in self.decoder.topics
+                       if self.decoder.name_lookup[x] in self.events]
+
+        self.backfill = Backfill(self, chunk_size=self.contract.get('backfillChunkSize', BACKFILL_CHUNK_SIZE),
+                                 concurrency=self.contract.get('backfillConcurrency', BACKFILL_CONCURRENCY),
+                                 batch_size=self.contract.get('backfillBatchSize', BACKFILL_BATCH_SIZE))
+
         log.info("ContractListener initialized for %s", self.contract['address'])
 
-        # Set the start block number if we have it
-        if hasattr(self.contract, "block_number"):
-            block_no = self.contract['block_number']
+        # Resume after the last block we scanned, or start at the configured
+        # startBlock if we've never scanned this contract
+        last_block = self.checkpoints.get(self.contract['address'], self.events)
+        if last_block is not None:
+            self.block_number = hex(last_block + 1)
+            log.info("Resuming %s from block %s", self.contract['address'], last_block + 1)
+        else:
+            block_no = self.contract.get('startBlock', 0)
             if type(block_no) == int:
                 block_no = hex(block_no)
             self.block_number = block_no
-        else:
-            self.block_number = hex(0)
+
+    def checkpoint(self, block_number):
+        """ Record that everything up to and including block_number is scanned """
+        self.checkpoints.set(self.contract['address'], self.events, block_number)
+        self.block_number = hex(block_number + 1)
+        log.debug('New start block {}'.format(self.block_number))
+
+    def report_progress(self, head):
+        behind = head - int(self.block_number, 16) + 1
+        metrics.BLOCKS_BEHIND.labels(self.contract['address'].lower()).set(max(0, behind))
+
+    def rewind(self, block_number):
+        """ Move the checkpoint back to block_number if we're past it """
+        if int(self.block_number, 16) > block_number + 1:
+            self.checkpoint(block_number)
 
     def pin(self, file_hash):
         """ Add an MQ job to pin a file hash """
+        if self.dedup is not None and file_hash in self.dedup and \
+                file_hash not in self.reorg.orphaned:
+            log.debug("Already queued {}".format(file_hash))
+            metrics.DUPLICATES.labels(self.contract['address'].lower()).inc()
+            return
         log.debug("Queuing {}".format(file_hash))
-        return self.queue.append(file_hash)
+        metrics.HASHES_QUEUED.labels(self.contract['address'].lower(), self.lane).inc()
+        result = self.queue.append(file_hash, lane=self.lane)
+        if self.dedup is not None:
+            self.dedup.add(file_hash)
+        self.reorg.requeued([file_hash])
+        return result
+
+    def pin_many(self, file_hashes, dedup=True, lane=None):
+        """ Add MQ jobs for many file hashes in as few round trips as we can.
+            Returns the hashes queued.
+        """
+        total = len(file_hashes)
+        if dedup and self.dedup is not None:
+            # Hashes a reorg took off of the queue go back on wherever
+            # they're mined again, even though the filter has seen them
+            orphaned = self.reorg.orphaned
+            if orphaned:
+                present = self.dedup.contains_many(file_hashes)
+                file_hashes = list(OrderedDict.fromkeys(
+                    x for x, seen in zip(file_hashes, present) if not seen or x in orphaned))
+            else:
+                file_hashes = self.dedup.filter_new(file_hashes)
+        log.debug("Queuing %s hashes (%s duplicates skipped)", len(file_hashes),
+                  total - len(file_hashes))
+        lane = lane or self.lane
+        self.queue.append_many(file_hashes, lane=lane)
+        if self.dedup is not None:
+            # Only marked once they're queued, so hashes from a push that
+            # failed aren't skipped when the range is scanned again.  Hashes
+            # that skipped the check are marked too so other listeners skip
+            # them.
+            self.dedup.add_many(file_hashes)
+        self.reorg.requeued(file_hashes)
+        address = self.contract['address'].lower()
+        metrics.HASHES_QUEUED.labels(address, lane).inc(len(file_hashes))
+        metrics.DUPLICATES.labels(address).inc(total - len(file_hashes))
+        return file_hashes
 
     def process_logs(self, logs):
         """ Process the logs received from JSON-RPC """
         return self.decoder.process_logs(logs)
 
-    def process_events(self):
-        """ Processes the events and pins when a new event comes in """
-        
-        while self.running:
-            payload = {
-                "method": 'eth_getLogs',
-                "params": [{
-                    "address": self.contract['address'],
-                    "fromBlock": self.block_number,
-                }],
-                "id": int(time.time())
-            }
-            hashes = []
-
-            log.debug(payload)
-
-            req = requests.post(self.server, json=payload, 
-                                   headers={'Content-Type': 'application/json'})
-
-            log.debug("received logs from server")
-            
-            try:
-                result = req.json()
-            except json.decoder.JSONDecodeError:
-                log.error("Unexpected response from JSON-RPC server")
-                result = None
-
-            if result:
-
-                processed_events = self.process_logs(result.get('result'))
-
-                for event in processed_events:
-                    if event['name'] in self.events:
-                        hash_hex = event['args'][self.event_param[event['name']]]
-                        ipfs_hex = '1220' + hash_hex[2:]
-                        b58_hash = base58.b58encode(decode_hex(ipfs_hex))
-                        hashes.append(b58_hash)
-
-                if len(hashes) > 0:
-                    self.block_number = hex(int(result['result'][-1]['blockNumber'], 16) + 1)
-                    log.debug('New start block {}'.format(self.block_number))
-                log.info("Total IPFS Hashes found: %s", len(hashes))
-                log.debug("Hashes found: %s", hashes)
-
-                for h in hashes:
-                    self.pin(h)
-
-                end = len(self.backlog)
-                i = 0
-                if end > 0:
-                    log.debug("Trying to cleanup the backlog")
-                    while h in self.backlog.pop(0):
-                        i += 1
-                        res = self.pin(h)
-                        if res is True:
-                            self.backlog.append(h)
-                        # Only process the backlog once until the next iteration
-                        if i >= end:
-                            break
-
-            time.sleep(15)
-
-def process_contract(contract, jsonrpc_server, redis_host, redis_port):
+    def log_filter(self, from_block, to_block):
+        """ eth_getLogs filter for our contract's events in a block range """
+        log_filter = {
+            "address": self.contract['address'],
+            "fromBlock": hex(from_block),
+            "toBlock": hex(to_block),
+        }
+        if self.topics:
+            log_filter['topics'] = [self.topics]
+        return log_filter
+
+    def hashes_from_logs(self, logs):
+        """ Generate the IPFS hashes from the events we track in logs, in
+            block order
+        """
+        return self.pipeline.hashes(self.contract, logs)
+
+    def handle_logs(self, logs):
+        """ Queue the hashes found in logs as they're decoded.  Returns the
+            number found.
+        """
+        # Logs are in block order.  Everything from the tracked window near
+        # the head is new, the rest is history.
+        split = len(logs)
+        while split > 0 and int(logs[split - 1]['blockNumber'], 16) >= self.reorg.track_from:
+            split -= 1
+
+        found = 0
+        if split > 0:
+            found += self.handle_old_logs(logs[:split])
+        if split < len(logs):
+            found += self.handle_recent_logs(logs[split:])
+        return found
+
+    def handle_old_logs(self, logs):
+        """ Queue the hashes found in historical logs on the backfill lane """
+        found = 0
+        hashes = []
+        for ipfs_hash in self.hashes_from_logs(logs):
+            hashes.append(ipfs_hash)
+            if len(hashes) >= PUSH_CHUNK_SIZE:
+                self.pin_many(hashes, lane=BACKFILL)
+                found += len(hashes)
+                hashes = []
+        if hashes:
+            log.debug("Hashes found: %s", hashes)
+            self.pin_many(hashes, lane=BACKFILL)
+            found += len(hashes)
+        return found
+
+    def handle_recent_logs(self, logs):
+        """ Queue the hashes found in logs near the head, remembering which
+            block each came from in case it gets orphaned
+        """
+        by_block = OrderedDict()
+        for evnt in logs:
+            by_block.setdefault(int(evnt['blockNumber'], 16), []).append(evnt)
+
+        found = 0
+        for number, block_logs in by_block.items():
+            hashes = list(self.hashes_from_logs(block_logs))
+            found += len(hashes)
+            queued = self.pin_many(hashes)
+            self.reorg.record_hashes(number, queued)
+
+        return found
+
+class MultiContractListener(BaseListener):
+    """ Listens for events from many contracts with one eth_getLogs filter
+        covering all of their addresses and tracked topics, and routes the
+        logs to each contract's ContractListener by address
+    """
+    def __init__(self, contracts, jsonrpc_server, redis_host='localhost', redis_port=6379,
+                 dedup=None, chunk_size=BACKFILL_CHUNK_SIZE, concurrency=BACKFILL_CONCURRENCY,
+                 batch_size=BACKFILL_BATCH_SIZE, notifier=None, client=None, pipeline=None,
+                 confirmations=0, queue_url=None):
+        self.server = jsonrpc_server
+        self.reorg = ReorgTracker()
+        self.notifier = notifier
+        self.client = client
+        if self.client is None:
+            self.client = JSONRPCClient(jsonrpc_server)
+        self.future = Future()
+        self.running = True
+        self.queue = open_queue(queue_url, 'hashes', redis_host=redis_host, redis_port=redis_port)
+        self.checkpoints = Checkpoints(host=redis_host, port=redis_port)
+
+        self.routes = {}
+        for contract in contracts:
+            self.routes[contract['address'].lower()] = ContractListener(
+                contract, jsonrpc_server, dedup=dedup, queue=self.queue,
+                checkpoints=self.checkpoints, client=self.client, pipeline=pipeline,
+                confirmations=confirmations, reorg=self.reorg)
+
+        # One scan covers every contract, so it waits for the most
+        # confirmations any of them asks for
+        self.confirmations = max([confirmations] +
+                                 [x.confirmations for x in self.routes.values()])
+        self.addresses = [x.contract['address'] for x in self.routes.values()]
+        self.topics = sorted(set(t for x in self.routes.values() for t in x.topics))
+        self.backfill = Backfill(self, chunk_size=chunk_size, concurrency=concurrency,
+                                 batch_size=batch_size)
+
+        log.info("MultiContractListener initialized for %s contracts", len(self.routes))
+
+    @property
+    def block_number(self):
+        """ The earliest block any of our contracts still needs """
+        return hex(min(int(x.block_number, 16) for x in self.routes.values()))
+
+    def checkpoint(self, block_number):
+        """ Record block_number as scanned for every contract not already past it """
+        behind = [x for x in self.routes.values() if int(x.block_number, 16) <= block_number]
+        self.checkpoints.set_many([(x.contract['address'], x.events) for x in behind],
+                                  block_number)
+        for listener in behind:
+            listener.block_number = hex(block_number + 1)
+
+    def report_progress(self, head):
+        for listener in self.routes.values():
+            listener.report_progress(head)
+
+    def rewind(self, block_number):
+        """ Move every contract past block_number back to it """
+        ahead = [x for x in self.routes.values() if int(x.block_number, 16) > block_number + 1]
+        self.checkpoints.set_many([(x.contract['address'], x.events) for x in ahead],
+                                  block_number)
+        for listener in ahead:
+            listener.block_number = hex(block_number + 1)
+
+    def log_filter(self, from_block, to_block):
+        """ eth_getLogs filter for all of our contracts in a block range """
+        log_filter = {
+            "address": self.addresses,
+            "fromBlock": hex(from_block),
+            "toBlock": hex(to_block),
+        }
+        if self.topics:
+            log_filter['topics'] = [self.topics]
+        return log_filter
+
+    def handle_logs(self, logs):
+        """ Route logs to their contract's listener.  Logs for blocks a contract
+            has already scanned are skipped.  Returns the number of hashes found.
+        """
+        grouped = {}
+        for evnt in logs:
+            grouped.setdefault(evnt['address'].lower(), []).append(evnt)
+
+        found = 0
+        for address, contract_logs in grouped.items():
+            listener = self.routes.get(address)
+            if listener is None:
+                log.warning("Received logs for unknown contract %s", address)
+                continue
+            start = int(listener.block_number, 16)
+            contract_logs = [x for x in contract_logs if int(x['blockNumber'], 16) >= start]
+            found += listener.handle_logs(contract_logs)
+
+        return found
+
+def process_contract(contract, jsonrpc_server, redis_host, redis_port, dedup=None, notifier=None,
+                     client=None, pipeline=None, confirmations=0, queue_url=None):
     log.debug("process_contract(%s, %s)", contract['address'], jsonrpc_server)
-    listener = ContractListener(contract, jsonrpc_server, redis_host=redis_host, redis_port=redis_port)
+    listener = ContractListener(contract, jsonrpc_server, redis_host=redis_host, redis_port=redis_port,
+                                dedup=dedup, notifier=notifier, client=client, pipeline=pipeline,
+                                confirmations=confirmations, queue_url=queue_url)
+    listener.process_events()
+    return listener.future
+
+def process_contracts(contracts, jsonrpc_server, redis_host, redis_port, dedup=None,
+                      chunk_size=BACKFILL_CHUNK_SIZE, concurrency=BACKFILL_CONCURRENCY,
+                      batch_size=BACKFILL_BATCH_SIZE, notifier=None, client=None, pipeline=None,
+                      confirmations=0, queue_url=None):
+    log.debug("process_contracts(%s contracts, %s)", len(contracts), jsonrpc_server)
+    listener = MultiContractListener(contracts, jsonrpc_server, redis_host=redis_host,
+                                     redis_port=redis_port, dedup=dedup,
+                                     chunk_size=chunk_size, concurrency=concurrency,
+                                     batch_size=batch_size, notifier=notifier, client=client,
+                                     pipeline=pipeline, confirmations=confirmations,
+                                     queue_url=queue_url)
     listener.process_events()
     return listener.future
@@ -0,0 +1,103 @@
+""" Prometheus metrics.  Everything here is a no-op unless prometheus_client
+    is installed and a metrics port is given.
+"""
+import time
+import logging
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+log = logging.getLogger('pinner.metrics')
+log.setLevel(logging.DEBUG)
+
+# Buckets in seconds
+PIN_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+RPC_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DECODE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+class NullMetric(object):
+    """ Stands in for a metric when prometheus_client isn't installed """
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def metric(kind, name, documentation, labels=(), **kwargs):
+    if prometheus_client is None:
+        return NullMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labels, **kwargs)
+
+
+@contextmanager
+def timed(histogram):
+    """ Observe how long the block takes """
+    start = time.time()
+    try:
+        yield
+    finally:
+        histogram.observe(time.time() - start)
+
+
+def start_server(port):
+    """ Serve metrics over HTTP on port.  Returns False if it can't. """
+    if prometheus_client is None:
+        log.warning("prometheus_client is not installed.  Not serving metrics.")
+        return False
+    prometheus_client.start_http_server(port)
+    log.info("Serving metrics on port %s", port)
+    return True
+
+
+# Pinner
+PIN_SECONDS = metric('Histogram', 'pinner_pin_seconds',
+                     'Time for a pin request on a node, by hashes in the request',
+                     ['node', 'batch_size'], buckets=PIN_BUCKETS)
+PINS = metric('Counter', 'pinner_pins_total', 'Pin attempts by outcome',
+              ['node', 'result'])
+PIN_BLOCKS = metric('Counter', 'pinner_pin_blocks_total', 'Blocks fetched by pins on a node',
+                    ['node'])
+ALREADY_PINNED = metric('Counter', 'pinner_already_pinned_total',
+                        'Hashes taken off of the queue that were already pinned')
+RETRIES = metric('Counter', 'pinner_retries_total', 'Hashes scheduled for a retry')
+DEAD_LETTERS = metric('Counter', 'pinner_dead_letters_total',
+                      'Hashes moved to the dead-letter list')
+QUEUE_DEPTH = metric('Gauge', 'pinner_queue_depth', 'Hashes waiting on each queue lane',
+                     ['lane'])
+RETRY_SCHEDULED = metric('Gauge', 'pinner_retry_scheduled',
+                         'Hashes waiting for their retry to come due')
+DEAD_LETTERED = metric('Gauge', 'pinner_dead_lettered', 'Hashes on the dead-letter list')
+IN_FLIGHT = metric('Gauge', 'pinner_in_flight', 'Pins in flight on each node', ['node'])
+
+# Listener
+RPC_SECONDS = metric('Histogram', 'pinner_rpc_seconds', 'JSON-RPC request time by method',
+                     ['method'], buckets=RPC_BUCKETS)
+RPC_ERRORS = metric('Counter', 'pinner_rpc_errors_total', 'Failed JSON-RPC requests by method',
+                    ['method'])
+DECODE_SECONDS = metric('Histogram', 'pinner_decode_seconds',
+                        'Time spent decoding a batch of logs', buckets=DECODE_BUCKETS)
+LOGS_DECODED = metric('Counter', 'pinner_logs_decoded_total', 'Logs decoded')
+HASHES_QUEUED = metric('Counter', 'pinner_hashes_queued_total', 'Hashes queued for pinning',
+                       ['contract', 'lane'])
+DUPLICATES = metric('Counter', 'pinner_duplicates_skipped_total',
+                    'Hashes not queued because they were seen before', ['contract'])
+BLOCKS_BEHIND = metric('Gauge', 'pinner_blocks_behind', 'Blocks left to scan to reach the head',
+                       ['contract'])
+REORGS = metric('Counter', 'pinner_reorgs_total', 'Chain reorgs detected')
+
+# Both
+RATE_LIMITED_SECONDS = metric('Counter', 'pinner_rate_limited_seconds_total',
+                              'Seconds spent waiting on a rate limit', ['limit'])
+CONCURRENCY_LIMIT = metric('Gauge', 'pinner_concurrency_limit',
+                           'Current adaptive concurrency limit', ['limit'])
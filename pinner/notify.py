@@ -0,0 +1,137 @@
+""" New block notifications so listeners can fetch logs as soon as a block
+    arrives instead of sleeping between polls
+"""
+import json
+import time
+import logging
+import threading
+from .jsonrpc import RPCError
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+log = logging.getLogger('pinner.notify')
+log.setLevel(logging.DEBUG)
+
+# Seconds between eth_getFilterChanges calls
+FILTER_INTERVAL = 2
+# Seconds without a message before a WebSocket subscription is considered dead
+SUBSCRIPTION_TIMEOUT = 120
+# Seconds to wait before resubscribing.  Doubles on each failure.
+RESUBSCRIBE_DELAY = 5
+RESUBSCRIBE_DELAY_MAX = 300
+
+
+class BlockNotifier(object):
+    """ Watches for new blocks and wakes up listeners waiting on one.  Uses an
+        eth_subscribe newHeads subscription when a WebSocket endpoint is
+        given and websocket-client is installed, otherwise an
+        eth_newBlockFilter.  While neither is working `subscribed` is False
+        and listeners should poll on their own.
+    """
+    def __init__(self, client, ws_server=None):
+        self.client = client
+        self.ws_server = ws_server
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.head = None
+        self.subscribed = False
+        self.running = True
+        self.thread = None
+
+    def start(self):
+        if self.ws_server and websocket is None:
+            log.warning("websocket-client is not installed.  Using a block filter instead.")
+
+        if self.ws_server and websocket is not None:
+            target = self.run_websocket
+        else:
+            target = self.run_filter
+
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+
+    def notify(self, head=None):
+        """ Wake up everyone waiting for a new block """
+        with self.cond:
+            if head is not None:
+                self.head = head
+            self.generation += 1
+            self.cond.notify_all()
+
+    def wait(self, generation, timeout):
+        """ Wait up to timeout seconds for a block newer than generation.
+            Returns the current generation.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.generation != generation, timeout=timeout)
+            return self.generation
+
+    def resubscribe_delay(self, delay):
+        self.subscribed = False
+        if self.running:
+            time.sleep(delay)
+        return min(delay * 2, RESUBSCRIBE_DELAY_MAX)
+
+    def run_websocket(self):
+        """ Follow newHeads over a WebSocket subscription """
+        delay = RESUBSCRIBE_DELAY
+        while self.running:
+            ws = None
+            try:
+                ws = websocket.create_connection(self.ws_server, timeout=SUBSCRIPTION_TIMEOUT)
+                ws.send(json.dumps({
+                    "jsonrpc": "2.0",
+                    "id": 1,
+                    "method": "eth_subscribe",
+                    "params": ["newHeads"],
+                }))
+                reply = json.loads(ws.recv())
+                if reply.get('error'):
+                    raise RPCError(reply['error'].get('message'), code=reply['error'].get('code'))
+
+                log.info("Subscribed to new blocks at %s", self.ws_server)
+                self.subscribed = True
+                delay = RESUBSCRIBE_DELAY
+                # Check for anything we missed while we weren't subscribed
+                self.notify()
+
+                while self.running:
+                    message = json.loads(ws.recv())
+                    if message.get('method') == 'eth_subscription':
+                        block = message['params']['result']
+                        self.notify(int(block['number'], 16))
+            except Exception as ex:
+                log.warning("Block subscription dropped (%s).  Falling back to polling.", ex)
+            finally:
+                if ws is not None:
+                    ws.close()
+
+            delay = self.resubscribe_delay(delay)
+
+    def run_filter(self):
+        """ Follow new blocks with an eth_newBlockFilter """
+        delay = RESUBSCRIBE_DELAY
+        while self.running:
+            try:
+                filter_id = self.client.call('eth_newBlockFilter', [])
+                log.info("Watching for new blocks with filter %s", filter_id)
+                self.subscribed = True
+                delay = RESUBSCRIBE_DELAY
+                self.notify(int(self.client.call('eth_blockNumber', []), 16))
+
+                while self.running:
+                    if self.client.call('eth_getFilterChanges', [filter_id]):
+                        # Look up the head once for every listener
+                        self.notify(int(self.client.call('eth_blockNumber', []), 16))
+                    time.sleep(FILTER_INTERVAL)
+            except Exception as ex:
+                log.warning("Block filter failed (%s).  Falling back to polling.", ex)
+
+            delay = self.resubscribe_delay(delay)
@@ -1,93 +1,361 @@
-import sys
+import os
 import time
+import socket
 import logging
-import ipfsapi
-import subprocess
-from .queue import RedisQueue
+import threading
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .ipfs import IPFSError, IPFSTimeout, IPFSStalled, IPFSUnavailable, to_str
+from .queue import open_queue, REALTIME, BACKFILL, RETRY
+from .cluster import Cluster, IPFSNode, parse_nodes
+from .limits import AdaptiveLimit
+from . import metrics
 
-QUEUE_NAME = '/pinner.ipc'
-TIMEOUT = 60
+# Seconds a pin may go without the node fetching another block before it's
+# abandoned.  There's no limit on how long a pin that's making progress takes.
+STALL_TIMEOUT = 30
+CONCURRENCY = 10
+# Hashes sent to a node in one pin/add
+BATCH_SIZE = 4
+# Seconds a node can take to start fetching a pin, or to answer one it already
+# has, above which it's taken to be overloaded and fewer pins are run at once
+PIN_LATENCY_TARGET = 2
+# Seconds to block on the queue waiting for new hashes
+POP_TIMEOUT = 5
+# Seconds between queue size log lines
+STATS_INTERVAL = 60
+# Seconds between heartbeats, retry promotion and reaping of dead workers
+MAINTENANCE_INTERVAL = 10
+# Seconds between reconciles of the pin index against the node's pin list
+RECONCILE_INTERVAL = 3600
 
 log = logging.getLogger('pinner.pinner')
 log.setLevel(logging.DEBUG)
 
-def quit_function(fn_name):
-    log.warning('%s took too long', fn_name)
-    sys.stderr.flush()
-    #thread.interrupt_main()
-    raise Exception("Timeout of some shit")
 
-def pin_hash(qmHash, ipfs_server, ipfs_port=5001):
-    """ Pin an ipfs hash using subprocess for timeout """
-    log.debug("pin_hash")
-    cmd = ['pin_one', '-p', str(ipfs_port), ipfs_server, qmHash]
-    subprocess.run(cmd, timeout=TIMEOUT, check=True)
-    log.debug("pin_hash+")
+def pin_hashes(hashes, node, stall_timeout=STALL_TIMEOUT, progress=None):
+    """ Pin ipfs hashes on a node in one request over its shared IPFS client,
+        following the blocks fetched so that only a pin that has stopped
+        making progress times out.  progress is called with the block count
+        as it grows.
+    """
+    start = time.time()
+    fetched = [0]
+
+    def track(blocks):
+        metrics.PIN_BLOCKS.labels(node.name).inc(blocks - fetched[0])
+        fetched[0] = blocks
+        if progress is not None:
+            progress(blocks)
+
+    pinned = node.pin(hashes, stall_timeout=stall_timeout, progress=track)
+    # Failures are mostly timeouts, which would swamp the distribution
+    metrics.PIN_SECONDS.labels(node.name, len(hashes)).observe(time.time() - start)
+    return pinned
+
+
+def pin_hash(qmHash, node, stall_timeout=STALL_TIMEOUT):
+    """ Pin a single ipfs hash on a node """
+    return pin_hashes([qmHash], node, stall_timeout=stall_timeout)
 
 
 class Pinner(object):
     """ Listen to the message queue for IPFS files to pin """
 
-    def __init__(self, ipfs_server, ipfs_port=5001, redis_host='localhost', redis_port=6379):
-        self.ipfs = None
+    def __init__(self, ipfs_server, ipfs_port=5001, redis_host='localhost', redis_port=6379,
+                 concurrency=CONCURRENCY, weights=None, replicas=1, queue_url=None,
+                 batch_size=BATCH_SIZE, stall_timeout=STALL_TIMEOUT, ipfs_rate=None):
         self.ipfs_server = ipfs_server
         self.ipfs_port = ipfs_port
+        self.concurrency = concurrency
+        self.batch_size = max(1, batch_size)
+        self.stall_timeout = stall_timeout
+        # One slot per in-flight pin.  We only take work off of the queue when
+        # a slot is free so the backlog stays in Redis for the other workers.
+        # There are fewer slots while the nodes are failing or slow.
+        self.slots = AdaptiveLimit('pins', concurrency, latency_target=PIN_LATENCY_TARGET)
         self.queue = None
-        self.backlog = []
-        self.dest_pins = []
+        # Background reconcile threads by node name
+        self.reconcilers = {}
+
+        # ipfs_server can be a comma separated list of host[:port] to pin each
+        # hash to `replicas` of them
+        nodes = [IPFSNode(host, port, pool_size=concurrency, redis_host=redis_host,
+                          redis_port=redis_port, rate=ipfs_rate)
+                 for host, port in parse_nodes(ipfs_server, ipfs_port)]
+        self.cluster = Cluster(nodes, replicas=replicas)
+        # Pins to each node for a hash run at the same time
+        self.fanout = ThreadPoolExecutor(max_workers=concurrency * self.cluster.replicas)
 
         # Connect to IPFS and be delay-tollerant for docker implementations
-        ipfs_retries = 5
-        ipfs_retry_count = 0
-        while self.ipfs is None:
-            try:
-                self.ipfs = ipfsapi.connect(ipfs_server, ipfs_port)
-            except ipfsapi.exceptions.ConnectionError as ex:
-                if ipfs_retry_count >= ipfs_retries:
-                    log.exception("Retried connection {} times.".format(ipfs_retries))
-                    raise ex
-                else:
-                    log.debug("Error connecting to IPFS.  Retrying in 3s...")
-            
-            # Cool down for 3s
-            time.sleep(3)
-
-            ipfs_retry_count += 1
-
-        self.queue = RedisQueue('hashes', host=redis_host, port=redis_port)
-
-        # Get all of the pins on the node
-        pins = self.ipfs.pin_ls(type='all').get('Keys')
-        self.dest_pins = [x.encode('utf-8') for x in pins.keys()]
-        log.debug("IPFS Pins on the destination node: %s", self.dest_pins)
+        try:
+            self.cluster.connect()
+        except IPFSError:
+            log.exception("Could not connect to IPFS.")
+            raise
+
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        # Realtime, backfill and retry lanes are shared out by weights
+        self.queue = open_queue(queue_url, 'hashes', worker_id=self.worker_id, weights=weights,
+                                redis_host=redis_host, redis_port=redis_port)
+        self.queue.heartbeat()
+        # A restarted worker can come back with the same host and pid (pid 1
+        # in a container), so recover anything it had in flight before
+        recovered = self.queue.requeue_in_flight()
+        if recovered:
+            log.warning("Requeued %s hashes left in flight by a previous run", recovered)
+
+        # Only one worker needs to build each index.  The rest wait for it.
+        for node in self.cluster.nodes:
+            if node.is_up() and not node.pins.is_fresh(RECONCILE_INTERVAL):
+                if not self.reconcile_pins(node):
+                    log.info("Waiting for another worker to load the pin index of %s...",
+                             node.name)
+                    node.pins.wait_ready()
+
+    def reconcile_pins(self, node):
+        """ Sync a node's shared pin index with the pins on the node, streaming
+            the pin list.  Returns False if another worker is already doing it.
+        """
+        start = time.time()
+        try:
+            total = node.pins.reconcile(node.client.pin_ls_stream(type='all'))
+        except IPFSError as ex:
+            log.warning("Could not load the pins on %s: %s", node.name, ex)
+            node.mark_down()
+            return True
+        if total is None:
+            log.debug("Another worker is already reconciling the pin index of %s", node.name)
+            return False
+
+        log.info("Loaded %s IPFS pins on %s in %.1fs", total, node.name, time.time() - start)
+        return True
+
+    def pin_to(self, node, messages):
+        """ Pin hashes to one node in one request.  Returns the hashes that
+            were pinned.  If IPFS names the hash that failed, the rest are
+            pinned again without it.  Otherwise the whole batch fails and each
+            hash is retried on its own schedule.
+        """
+        responded = []
+
+        def progress(blocks):
+            if not responded:
+                responded.append(time.time())
+
+        start = time.time()
+        try:
+            pin_hashes(messages, node, stall_timeout=self.stall_timeout, progress=progress)
+            log.debug("Pinned %s on %s", ', '.join(to_str(x) for x in messages), node.name)
+            metrics.PINS.labels(node.name, 'pinned').inc(len(messages))
+            # The rest of a pin depends on the size of the content, so judge
+            # the node by how long it took to start fetching, or to answer if
+            # it had everything already
+            self.slots.record(True, (responded[0] if responded else time.time()) - start)
+            return list(messages)
+        except IPFSStalled:
+            # Usually content nobody is providing rather than a busy node
+            outcome = 'stalled'
+        except IPFSTimeout:
+            outcome = 'timeout'
+            self.slots.record(False)
+        except IPFSUnavailable:
+            log.warning("IPFS node %s is unavailable.", node.name)
+            metrics.PINS.labels(node.name, 'unavailable').inc(len(messages))
+            self.slots.record(False)
+            return []
+        except IPFSError as err:
+            # Mostly bad hashes, which say nothing about the node's load
+            outcome = 'error'
+            error = str(err)
+        except Exception as err:
+            log.exception("Unhandled error pinning %s on %s.",
+                          ', '.join(to_str(x) for x in messages), node.name)
+            outcome = 'error'
+            error = str(err)
+
+        if outcome == 'error' and len(messages) > 1:
+            failed = [x for x in messages if to_str(x) in error]
+            if len(failed) == 1:
+                log.warning("Could not pin %s on %s: %s", to_str(failed[0]), node.name, error)
+                metrics.PINS.labels(node.name, outcome).inc()
+                return self.pin_to(node, [x for x in messages if x != failed[0]])
+
+        hashes = ', '.join(to_str(x) for x in messages)
+        if outcome == 'stalled':
+            log.warning("Pin of %s on %s stopped making progress.", hashes, node.name)
+        elif outcome == 'timeout':
+            log.warning("Timeout has occurred when trying to pin %s on %s.", hashes, node.name)
+        else:
+            log.warning("An unknown error has occurred when trying to pin %s on %s: %s",
+                        hashes, node.name, error)
+        # Pinning them again one at a time here could hold the batch for
+        # stall_timeout per hash, so they go back on the queue instead
+        metrics.PINS.labels(node.name, outcome).inc(len(messages))
+        return []
+
+    def pin(self, messages, holders):
+        """ Pin a batch of hashes to the nodes each is missing from, acking
+            those that end up with enough replicas and scheduling retries for
+            the rest.  Hashes going to the same node share a request.
+        """
+        needed = OrderedDict()
+        tried = {}
+        for message, nodes in zip(messages, holders):
+            needed[message] = self.cluster.replicas - len(nodes)
+            tried[message] = list(nodes)
 
-    def process_jobs(self):
-        """ Process pinner jobs from the message queue """
         while True:
-            try:
-                message = self.queue.pop()
-                if message and message not in self.dest_pins:
-                    log.debug("Starting pin thread for %s", message)
-                    try:
-                        pin_hash(message, self.ipfs_server, self.ipfs_port)
-                        log.debug("Pinned {}".format(message))
-                    except subprocess.TimeoutExpired as err:
-                        log.warning("Timeout has occurred when trying to pin %s. Returning it to the queue...", message)
-                        self.queue.append(message)
-                    except subprocess.CalledProcessError as err:
-                        log.warning("An unknown error has occurred when trying to pin %s. Returning it to the queue...", message)
-                        self.queue.append(message)
-                elif message in self.dest_pins:
-                    log.debug("Pin exists on destination node.")
-                else:
-                    log.debug("No-op")
-                    time.sleep(3)
-            except KeyboardInterrupt:
-                log.info("Shutting down at request of user...")
-
-            log.debug("Items in backlog: %s", self.queue.qsize())
-
-def start_pinner(ipfs_host, ipfs_port, redis_host, redis_port):
-    pinner = Pinner(ipfs_host, ipfs_port, redis_host=redis_host, redis_port=redis_port)
+            # Fall back to other nodes for the ones that failed
+            batches = OrderedDict()
+            for message, count in needed.items():
+                if count <= 0:
+                    continue
+                targets = self.cluster.choose(tried[message], count)
+                tried[message].extend(targets)
+                for node in targets:
+                    batches.setdefault(node, []).append(message)
+            if not batches:
+                break
+
+            nodes = list(batches)
+            if len(nodes) == 1:
+                results = [self.pin_to(nodes[0], batches[nodes[0]])]
+            else:
+                results = list(self.fanout.map(self.pin_to, nodes, [batches[x] for x in nodes]))
+            for pinned in results:
+                for message in pinned:
+                    needed[message] -= 1
+
+        for message in messages:
+            if needed[message] <= 0:
+                self.queue.ack(message)
+            elif self.queue.fail(message):
+                log.info("Scheduled %s for retry", to_str(message))
+                metrics.RETRIES.inc()
+            else:
+                log.error("Giving up on %s.  Moved it to the dead-letter list.", to_str(message))
+                metrics.DEAD_LETTERS.inc()
+
+    def maintain(self):
+        """ Heartbeat, requeue due retries, and recover work from dead workers """
+        self.queue.heartbeat()
+        promoted = self.queue.promote_retries()
+        if promoted:
+            log.debug("Requeued %s hashes for retry", promoted)
+        reaped = self.queue.reap()
+        if reaped:
+            log.warning("Recovered %s in-flight hashes from dead workers", reaped)
+        for node in self.cluster.nodes:
+            if node.is_up() and not node.pins.is_fresh(RECONCILE_INTERVAL):
+                self.start_reconcile(node)
+        self.update_metrics()
+
+    def start_reconcile(self, node):
+        """ Reconcile a node's pin index on a background thread.  Loading a big
+            pin list can take longer than the heartbeat TTL, and the main loop
+            has to keep heartbeating meanwhile or other workers will reap the
+            pins we have in flight.
+        """
+        running = self.reconcilers.get(node.name)
+        if running is not None and running.is_alive():
+            return
+        thread = threading.Thread(target=self.reconcile_pins, args=(node,), daemon=True,
+                                  name='reconcile-{}'.format(node.name))
+        self.reconcilers[node.name] = thread
+        thread.start()
+
+    def update_metrics(self):
+        for lane, size in self.queue.lane_sizes().items():
+            metrics.QUEUE_DEPTH.labels(lane).set(size)
+        metrics.RETRY_SCHEDULED.set(self.queue.retry_size())
+        metrics.DEAD_LETTERED.set(self.queue.dead_size())
+        for node in self.cluster.nodes:
+            metrics.IN_FLIGHT.labels(node.name).set(node.in_flight)
+
+    def batches(self, messages, holders):
+        """ Split hashes into (hashes, holders) pin requests of up to
+            batch_size.  Hashes that have failed before get a request each,
+            so one that can't be fetched doesn't stall a batch of healthy ones
+            and use up their attempts too.
+        """
+        fresh = []
+        retried = []
+        for message, nodes, attempts in zip(messages, holders, self.queue.attempts(messages)):
+            (retried if attempts else fresh).append((message, nodes))
+        batches = [[x] for x in retried]
+        batches.extend(fresh[i:i + self.batch_size]
+                       for i in range(0, len(fresh), self.batch_size))
+        return [([x[0] for x in batch], [x[1] for x in batch]) for batch in batches]
+
+    def release_slots(self, count, future):
+        for i in range(count):
+            self.slots.release()
+
+    def process_jobs(self):
+        """ Process pinner jobs from the message queue, keeping up to
+            `concurrency` pins in flight at once.
+        """
+        last_stats = 0
+        last_maintenance = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while True:
+                if time.time() - last_maintenance > MAINTENANCE_INTERVAL:
+                    last_maintenance = time.time()
+                    self.maintain()
+
+                try:
+                    # Wait for a free slot, then claim whatever else is free so
+                    # we can take a whole batch off of the queue at once
+                    if not self.slots.acquire(timeout=POP_TIMEOUT):
+                        continue
+                    free = 1
+                    while free < self.concurrency and self.slots.acquire(blocking=False):
+                        free += 1
+
+                    messages = self.queue.pop_many(free, timeout=POP_TIMEOUT)
+                    for i in range(free - len(messages)):
+                        self.slots.release()
+
+                    if not messages:
+                        log.debug("No-op")
+
+                    batch = []
+                    batch_holders = []
+                    for message, holders in zip(messages, self.cluster.holders(messages)):
+                        if len(holders) >= self.cluster.replicas:
+                            self.queue.ack(message)
+                            self.slots.release()
+                            log.debug("Pin exists on destination nodes.")
+                            metrics.ALREADY_PINNED.inc()
+                        else:
+                            batch.append(message)
+                            batch_holders.append(holders)
+
+                    for chunk, chunk_holders in self.batches(batch, batch_holders):
+                        log.debug("Starting pin thread for %s hashes", len(chunk))
+                        future = pool.submit(self.pin, chunk, chunk_holders)
+                        future.add_done_callback(partial(self.release_slots, len(chunk)))
+                except KeyboardInterrupt:
+                    log.info("Shutting down at request of user...")
+
+                if time.time() - last_stats > STATS_INTERVAL:
+                    last_stats = time.time()
+                    sizes = self.queue.lane_sizes()
+                    log.debug("Items in backlog: %s (realtime: %s, backfill: %s, retry: %s), "
+                              "waiting to retry: %s, dead: %s", sum(sizes.values()),
+                              sizes[REALTIME], sizes[BACKFILL], sizes[RETRY],
+                              self.queue.retry_size(), self.queue.dead_size())
+
+def start_pinner(ipfs_host, ipfs_port, redis_host, redis_port, concurrency=CONCURRENCY,
+                 weights=None, replicas=1, metrics_port=None, queue_url=None,
+                 batch_size=BATCH_SIZE, stall_timeout=STALL_TIMEOUT, ipfs_rate=None):
+    if metrics_port:
+        metrics.start_server(metrics_port)
+    pinner = Pinner(ipfs_host, ipfs_port, redis_host=redis_host, redis_port=redis_port,
+                    concurrency=concurrency, weights=weights, replicas=replicas,
+                    queue_url=queue_url, batch_size=batch_size, stall_timeout=stall_timeout,
+                    ipfs_rate=ipfs_rate)
     pinner.process_jobs()
 
@@ -0,0 +1,190 @@
+""" Shared index of the hashes pinned on an IPFS node """
+import time
+import uuid
+import redis
+from .cache import LRUSet
+from .ipfs import to_str
+
+# Max items sent with a single SADD
+ADD_CHUNK_SIZE = 1000
+# Seconds a reconcile can go without renewing its lock before another worker
+# can take over
+RECONCILE_LOCK_TTL = 600
+# Seconds between renewals of the lock while the pin list streams in
+RECONCILE_LOCK_RENEW = 60
+# Hashes known to be pinned that each process remembers
+KNOWN_CACHE_SIZE = 100000
+
+
+class PinIndex(object):
+    """ Redis set of the hashes pinned on one IPFS node so that every worker
+        can check for an existing pin in constant time.  Workers add to it as
+        pins succeed, and it is periodically reconciled against `pin/ls`.
+        Hashes found to be pinned are also remembered locally so that hot
+        content skips the round trip.
+    """
+    def __init__(self, node, namespace='pins', cache_size=KNOWN_CACHE_SIZE, **redis_kwargs):
+        self._db = redis.Redis(**redis_kwargs)
+        self.known = LRUSet(cache_size)
+        self.known_built = None
+        self.key = '%s:%s' % (namespace, node)
+        # Pins added since the last reconcile started.  These are carried over
+        # so that a reconcile doesn't drop pins made while it was running.
+        self.new_key = '%s:new' % self.key
+        self.lock_key = '%s:lock' % self.key
+        # Timestamp of the last completed reconcile
+        self.built_key = '%s:built' % self.key
+
+    def __contains__(self, item):
+        item = to_str(item)
+        if item in self.known:
+            return True
+        if self._db.sismember(self.key, item):
+            self.known.add(item)
+            return True
+        return False
+
+    def __len__(self):
+        return self._db.scard(self.key)
+
+    def age(self):
+        """ Seconds since the last reconcile finished, or None if never """
+        built = self._db.get(self.built_key)
+        if built != self.known_built:
+            # Reconciled, maybe by another worker, so what we remember may
+            # have been unpinned since
+            self.known.clear()
+            self.known_built = built
+        if built is None:
+            return None
+        return time.time() - float(built)
+
+    def is_fresh(self, max_age):
+        age = self.age()
+        return age is not None and age < max_age
+
+    def is_reconciling(self):
+        return bool(self._db.exists(self.lock_key))
+
+    def wait_ready(self, timeout=RECONCILE_LOCK_TTL, interval=1):
+        """ Wait for a reconcile running in another worker to finish.  Returns
+            True if the index has been built.
+        """
+        deadline = time.time() + timeout
+        while self.is_reconciling() and time.time() < deadline:
+            time.sleep(interval)
+        return self.age() is not None
+
+    def contains_many(self, items):
+        """ Check membership for many items in one round trip """
+        if not items:
+            return []
+        items = [to_str(x) for x in items]
+        found = [x in self.known for x in items]
+        unknown = [x for x, known in zip(items, found) if not known]
+        if unknown:
+            pinned = iter(self._db.smismember(self.key, unknown))
+            found = [known or bool(next(pinned)) for known in found]
+            self.known.add_many([x for x, known in zip(items, found) if known])
+        return found
+
+    def add(self, item):
+        self.add_many([item])
+
+    def add_many(self, items):
+        items = [to_str(x) for x in items]
+        if not items:
+            return
+        pipe = self._db.pipeline(transaction=False)
+        pipe.sadd(self.key, *items)
+        pipe.sadd(self.new_key, *items)
+        pipe.execute()
+        self.known.add_many(items)
+
+    def discard(self, item):
+        item = to_str(item)
+        self.known.discard(item)
+        pipe = self._db.pipeline(transaction=False)
+        pipe.srem(self.key, item)
+        pipe.srem(self.new_key, item)
+        pipe.execute()
+
+    def renew_lock(self, token):
+        """ Push back the reconcile lock's expiry.  Returns False if we no
+            longer hold it.
+        """
+        with self._db.pipeline() as pipe:
+            try:
+                pipe.watch(self.lock_key)
+                if to_str(pipe.get(self.lock_key)) != token:
+                    return False
+                pipe.multi()
+                pipe.expire(self.lock_key, RECONCILE_LOCK_TTL)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def release_lock(self, token):
+        """ Drop the reconcile lock if we still hold it """
+        with self._db.pipeline() as pipe:
+            try:
+                pipe.watch(self.lock_key)
+                if to_str(pipe.get(self.lock_key)) != token:
+                    return
+                pipe.multi()
+                pipe.delete(self.lock_key)
+                pipe.execute()
+            except redis.WatchError:
+                pass
+
+    def reconcile(self, hashes):
+        """ Replace the index with the given hashes, keeping anything added
+            while we were loading them.  Only one worker reconciles at a time,
+            and the lock is renewed as the hashes stream in.  Returns the
+            number of hashes loaded or None if another worker holds the lock.
+        """
+        token = uuid.uuid4().hex
+        if not self._db.set(self.lock_key, token, nx=True, ex=RECONCILE_LOCK_TTL):
+            return None
+
+        # Each run builds its own set so a run that lost the lock can't touch
+        # the one that took it over
+        tmp_key = '%s:tmp:%s' % (self.key, token)
+        try:
+            total = 0
+            chunk = []
+            renewed = time.time()
+            for item in hashes:
+                chunk.append(item)
+                if len(chunk) >= ADD_CHUNK_SIZE:
+                    pipe = self._db.pipeline(transaction=False)
+                    pipe.sadd(tmp_key, *chunk)
+                    pipe.expire(tmp_key, RECONCILE_LOCK_TTL)
+                    pipe.execute()
+                    total += len(chunk)
+                    chunk = []
+                if time.time() - renewed > RECONCILE_LOCK_RENEW:
+                    if not self.renew_lock(token):
+                        return None
+                    renewed = time.time()
+            if chunk:
+                self._db.sadd(tmp_key, *chunk)
+                total += len(chunk)
+
+            with self._db.pipeline() as pipe:
+                try:
+                    pipe.watch(self.lock_key)
+                    if to_str(pipe.get(self.lock_key)) != token:
+                        return None
+                    pipe.multi()
+                    pipe.sunionstore(self.key, [tmp_key, self.new_key])
+                    pipe.delete(self.new_key)
+                    pipe.set(self.built_key, time.time())
+                    pipe.execute()
+                except redis.WatchError:
+                    return None
+            return total
+        finally:
+            self._db.delete(tmp_key)
+            self.release_lock(token)
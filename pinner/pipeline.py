@@ -0,0 +1,113 @@
+""" Decodes large batches of logs into IPFS hashes across a pool of processes """
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from .decoder import EventDecoder
+from .hashes import normalizer
+from . import metrics
+
+log = logging.getLogger('pinner.pipeline')
+log.setLevel(logging.DEBUG)
+
+# Logs handed to a worker process at a time
+CHUNK_SIZE = 5000
+# Batches with fewer logs than this are decoded in-process
+MIN_PARALLEL = 20000
+# Listeners run in threads, and forking a threaded process can copy locks
+# that are held, so workers come from a clean server process
+START_METHOD = 'forkserver'
+
+# Decoders built in this process, by contract address
+_decoders = {}
+
+
+def contract_decoder(contract):
+    """ Get the (decoder, {event: (hash param, normalizer)}) for a contract,
+        building them the first time a process sees it
+    """
+    address = contract['address'].lower()
+    if address not in _decoders:
+        event_param = {}
+        for evt in contract['events']:
+            event_param[evt['name']] = (evt['hashParam'], normalizer(evt))
+        _decoders[address] = (EventDecoder(contract['abi']), event_param)
+    return _decoders[address]
+
+
+def decode_chunk(contract, logs):
+    """ Decode logs and pull out the IPFS hashes from the events we track,
+        skipping any that aren't valid
+    """
+    decoder, event_param = contract_decoder(contract)
+    hashes = []
+    for event in decoder.process_logs(logs):
+        param = event_param.get(event['name'])
+        if param is None:
+            continue
+        value = event['args'][param[0]]
+        ipfs_hash = param[1](value)
+        if ipfs_hash is None:
+            log.warning("Skipping invalid hash %r in %s event", value, event['name'])
+            continue
+        hashes.append(ipfs_hash)
+    return hashes
+
+
+class DecodePipeline(object):
+    """ Decodes logs into IPFS hashes.  Big batches are split into chunks and
+        spread over a process pool, with the hashes yielded in block order as
+        each chunk finishes.  One pipeline can be shared by every listener in
+        a process.  The pool is started the first time a batch is big enough
+        to need it.
+    """
+    def __init__(self, processes=None, chunk_size=CHUNK_SIZE, min_parallel=MIN_PARALLEL):
+        self.processes = os.cpu_count() if processes is None else processes
+        self.chunk_size = chunk_size
+        self.min_parallel = min_parallel
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    def get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context(START_METHOD))
+            return self.pool
+
+    def shutdown(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def hashes(self, contract, logs):
+        """ Generate the IPFS hashes for a contract's logs """
+        metrics.LOGS_DECODED.inc(len(logs))
+        if self.processes < 2 or len(logs) < self.min_parallel:
+            with metrics.timed(metrics.DECODE_SECONDS):
+                hashes = decode_chunk(contract, logs)
+            for ipfs_hash in hashes:
+                yield ipfs_hash
+            return
+
+        log.debug("Decoding %s logs across %s processes", len(logs), self.processes)
+        chunks = [logs[i:i + self.chunk_size] for i in range(0, len(logs), self.chunk_size)]
+        # map() keeps the chunks in order.  Only the time spent waiting on the
+        # pool counts as decoding, not the time spent queuing what it yields.
+        waited = 0
+        start = time.time()
+        results = self.get_pool().map(decode_chunk, [contract] * len(chunks), chunks)
+        waited += time.time() - start
+        while True:
+            start = time.time()
+            chunk_hashes = next(results, None)
+            waited += time.time() - start
+            if chunk_hashes is None:
+                break
+            for ipfs_hash in chunk_hashes:
+                yield ipfs_hash
+        metrics.DECODE_SECONDS.observe(waited)
@@ -1,17 +1,373 @@
+import time
 import redis
 
-class RedisQueue(object):
-    """Simple Queue with Redis Backend"""
-    def __init__(self, name, namespace='queue', **redis_kwargs):
+# Max items sent with a single RPUSH
+PUSH_CHUNK_SIZE = 1000
+# Attempts before an item is moved to the dead-letter list
+MAX_ATTEMPTS = 5
+# Seconds before the first retry.  Doubles with each attempt.
+RETRY_BACKOFF = 30
+RETRY_BACKOFF_MAX = 3600
+# Seconds a worker can go without a heartbeat before its items are reaped
+HEARTBEAT_TTL = 60
+# Seconds a blocking pop waits on the realtime lane before checking the others
+BLOCK_SLICE = 1
+
+# Priority lanes, highest first
+REALTIME = 'realtime'
+BACKFILL = 'backfill'
+RETRY = 'retry'
+LANES = [REALTIME, BACKFILL, RETRY]
+# Relative share of pops each lane gets while they all have items waiting
+LANE_WEIGHTS = {REALTIME: 8, BACKFILL: 2, RETRY: 1}
+
+class LaneQueue(object):
+    """ Base for the queue backends.  Producers use append(), append_many()
+        and remove_many().  Workers pop with pop() and pop_many(), which share
+        pops between the lanes by weight, and then ack() or fail() each item.
+    """
+    def __init__(self, weights=None):
+        self.weights = dict(LANE_WEIGHTS)
+        self.weights.update(weights or {})
+        # Scheduling credit for each lane, carried between pops
+        self.credit = {lane: 0 for lane in LANES}
+
+    def schedule(self, count, sizes):
+        """ Split count pops between the lanes with items waiting, using smooth
+            weighted round robin.  Credit carries over between calls so every
+            lane gets its share even when popping one item at a time.  Returns
+            {lane: pops}.
+        """
+        sizes = dict(sizes)
+        plan = {lane: 0 for lane in LANES}
+        for i in range(count):
+            ready = [lane for lane in LANES if sizes[lane] > 0]
+            if not ready:
+                break
+            for lane in ready:
+                self.credit[lane] += self.weights[lane]
+            # Ties go to the higher priority lane
+            lane = max(ready, key=lambda x: self.credit[x])
+            self.credit[lane] -= sum(self.weights[x] for x in ready)
+            sizes[lane] -= 1
+            plan[lane] += 1
+        return plan
+
+
+class RedisQueue(LaneQueue):
+    """Simple Queue with Redis Backend.  Items are kept in priority lanes that
+    are popped from by weighted fair scheduling."""
+    def __init__(self, name, namespace='queue', weights=None, **redis_kwargs):
         """The default connection parameters are: host='localhost', port=6379, db=0"""
+        super(RedisQueue, self).__init__(weights=weights)
         self._db= redis.Redis(**redis_kwargs)
         self.key = '%s:%s' %(namespace, name)
 
-    def qsize(self):
-        return self._db.llen(self.key)
+    def lane_key(self, lane):
+        """ Redis key of a lane.  Realtime items live on the plain queue key so
+            anything pushing straight onto it gets realtime priority.
+        """
+        if lane not in LANES:
+            raise ValueError("Unknown queue lane {}".format(lane))
+        if lane == REALTIME:
+            return self.key
+        return '%s:lane:%s' % (self.key, lane)
+
+    def lane_sizes(self):
+        pipe = self._db.pipeline(transaction=False)
+        for lane in LANES:
+            pipe.llen(self.lane_key(lane))
+        return dict(zip(LANES, pipe.execute()))
+
+    def qsize(self, lane=None):
+        if lane is not None:
+            return self._db.llen(self.lane_key(lane))
+        return sum(self.lane_sizes().values())
+
+    def append(self, item, lane=REALTIME):
+        self._db.rpush(self.lane_key(lane), item)
+
+    def append_many(self, items, lane=REALTIME):
+        """ Append many items using pipelined RPUSHes """
+        items = list(items)
+        if not items:
+            return
+        key = self.lane_key(lane)
+        pipe = self._db.pipeline(transaction=False)
+        for i in range(0, len(items), PUSH_CHUNK_SIZE):
+            pipe.rpush(key, *items[i:i + PUSH_CHUNK_SIZE])
+        pipe.execute()
+
+    def remove_many(self, items):
+        """ Remove pending items from every lane.  Returns the count removed. """
+        if not items:
+            return 0
+        pipe = self._db.pipeline(transaction=False)
+        for lane in LANES:
+            key = self.lane_key(lane)
+            for item in items:
+                pipe.lrem(key, 0, item)
+        return sum(pipe.execute())
+
+    def pop(self, block=True, timeout=None):
+        """ Pop an item.  If block is set and a timeout is given, wait up to
+            timeout seconds for one (forever if it's 0).  Without a timeout
+            pop doesn't wait.  Returns None if nothing is available.
+        """
+        items = self.pop_many(1, block=False)
+        if items:
+            return items[0]
+        if block and timeout is not None:
+            # Whichever lane gets an item first
+            item = self._db.blpop([self.lane_key(x) for x in LANES], timeout=timeout)
+            if item:
+                return item[1]
+        return None
+
+    def pop_many(self, count, block=True, timeout=None):
+        """ Pop up to count items in one round trip, shared between the lanes
+            by weight.  If block is set and the queue is empty, wait up to
+            timeout seconds for the first one, as pop() does.
+        """
+        plan = self.schedule(count, self.lane_sizes())
+        pipe = self._db.pipeline(transaction=True)
+        for lane, pops in plan.items():
+            if pops:
+                pipe.lrange(self.lane_key(lane), 0, pops - 1)
+                pipe.ltrim(self.lane_key(lane), pops, -1)
+        items = []
+        for popped in pipe.execute()[::2]:
+            items.extend(popped)
+
+        if not items and block:
+            first = self.pop(block=True, timeout=timeout)
+            if first is None:
+                return []
+            items = [first]
+            if count > 1:
+                items.extend(self.pop_many(count - 1, block=False))
+
+        return items
+
+
+class ReliableQueue(RedisQueue):
+    """ RedisQueue that keeps popped items on a per-worker processing list
+        until they are acked.  Failed items are retried with exponential
+        backoff from a sorted set and dead-lettered after max_attempts.  Items
+        held by a worker whose heartbeat has expired are reaped back onto the
+        queue by any other worker.
+    """
+    def __init__(self, name, worker_id, namespace='queue', max_attempts=MAX_ATTEMPTS,
+                 backoff=RETRY_BACKOFF, max_backoff=RETRY_BACKOFF_MAX,
+                 heartbeat_ttl=HEARTBEAT_TTL, weights=None, **redis_kwargs):
+        super(ReliableQueue, self).__init__(name, namespace=namespace, weights=weights,
+                                            **redis_kwargs)
+        self.worker_id = worker_id
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.heartbeat_ttl = heartbeat_ttl
+
+        self.workers_key = '%s:workers' % self.key
+        self.processing_key = self.processing_key_for(worker_id)
+        self.origin_key = self.origin_key_for(worker_id)
+        self.heartbeat_key = self.heartbeat_key_for(worker_id)
+        self.retry_key = '%s:retry' % self.key
+        self.attempts_key = '%s:attempts' % self.key
+        self.dead_key = '%s:dead' % self.key
+
+    def processing_key_for(self, worker_id):
+        return '%s:processing:%s' % (self.key, worker_id)
+
+    def origin_key_for(self, worker_id):
+        """ Hash of the lane each item on a worker's processing list came
+            from.  Items that aren't in it came from the realtime lane.
+        """
+        return '%s:origin:%s' % (self.key, worker_id)
 
-    def append(self, item):
-        self._db.rpush(self.key, item)
+    def heartbeat_key_for(self, worker_id):
+        return '%s:heartbeat:%s' % (self.key, worker_id)
+
+    def in_flight(self):
+        return self._db.llen(self.processing_key)
 
     def pop(self, block=True, timeout=None):
-        return self._db.lpop(self.key)
\ No newline at end of file
+        """ Move an item onto our processing list and return it """
+        items = self.pop_many(1, block=False)
+        if items:
+            return items[0]
+        if not block or timeout is None:
+            return None
+
+        # BLMOVE can only watch one list.  Realtime items wake us up right
+        # away, and the other lanes are checked every BLOCK_SLICE seconds.
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            wait = BLOCK_SLICE
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return None
+            item = self._db.blmove(self.key, self.processing_key, wait, 'LEFT', 'RIGHT')
+            if item is not None:
+                return item
+            items = self.pop_many(1, block=False)
+            if items:
+                return items[0]
+
+    def pop_many(self, count, block=True, timeout=None):
+        """ Move up to count items, shared between the lanes by weight, onto
+            our processing list in one round trip
+        """
+        plan = self.schedule(count, self.lane_sizes())
+        lanes = []
+        pipe = self._db.pipeline(transaction=True)
+        for lane, pops in plan.items():
+            for i in range(0, pops):
+                pipe.lmove(self.lane_key(lane), self.processing_key, 'LEFT', 'RIGHT')
+                lanes.append(lane)
+        popped = pipe.execute()
+        items = [x for x in popped if x is not None]
+
+        # Remember where items off of the other lanes go back to if we die
+        origins = {item: lane for item, lane in zip(popped, lanes)
+                   if item is not None and lane != REALTIME}
+        if origins:
+            self._db.hset(self.origin_key, mapping=origins)
+
+        if not items and block:
+            first = self.pop(block=True, timeout=timeout)
+            if first is None:
+                return []
+            items = [first]
+            if count > 1:
+                items.extend(self.pop_many(count - 1, block=False))
+
+        return items
+
+    def ack(self, item):
+        """ Mark an item as done """
+        pipe = self._db.pipeline(transaction=True)
+        pipe.lrem(self.processing_key, 1, item)
+        pipe.hdel(self.attempts_key, item)
+        pipe.hdel(self.origin_key, item)
+        pipe.execute()
+
+    def fail(self, item):
+        """ Schedule an item for a delayed retry, or dead-letter it if it has
+            used up its attempts.  Returns True if it will be retried.
+        """
+        attempts = self._db.hincrby(self.attempts_key, item, 1)
+        pipe = self._db.pipeline(transaction=True)
+        pipe.lrem(self.processing_key, 1, item)
+        pipe.hdel(self.origin_key, item)
+        if attempts >= self.max_attempts:
+            pipe.rpush(self.dead_key, item)
+            pipe.hdel(self.attempts_key, item)
+            retry = False
+        else:
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            pipe.zadd(self.retry_key, {item: time.time() + delay})
+            retry = True
+        pipe.execute()
+        return retry
+
+    def attempts(self, items):
+        """ Times each item has failed so far """
+        if not items:
+            return []
+        return [int(x or 0) for x in self._db.hmget(self.attempts_key, items)]
+
+    def retry_size(self):
+        return self._db.zcard(self.retry_key)
+
+    def dead_size(self):
+        return self._db.llen(self.dead_key)
+
+    def promote_retries(self, limit=PUSH_CHUNK_SIZE):
+        """ Move retries that are due onto the retry lane.  Returns the count. """
+        due = self._db.zrangebyscore(self.retry_key, 0, time.time(), start=0, num=limit)
+        if not due:
+            return 0
+
+        # Only whoever manages to remove an item from the set requeues it
+        pipe = self._db.pipeline(transaction=False)
+        for item in due:
+            pipe.zrem(self.retry_key, item)
+        claimed = [item for item, removed in zip(due, pipe.execute()) if removed]
+        self.append_many(claimed, lane=RETRY)
+        return len(claimed)
+
+    def heartbeat(self):
+        """ Let the other workers know we're alive """
+        pipe = self._db.pipeline(transaction=False)
+        pipe.sadd(self.workers_key, self.worker_id)
+        pipe.set(self.heartbeat_key, int(time.time()), ex=self.heartbeat_ttl)
+        pipe.execute()
+
+    def requeue_in_flight(self, worker_id=None):
+        """ Push everything on a worker's processing list back to the front of
+            the lane it was popped from.  Returns the count.
+        """
+        processing_key = self.processing_key_for(worker_id or self.worker_id)
+        origin_key = self.origin_key_for(worker_id or self.worker_id)
+        moved = 0
+        with self._db.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(processing_key)
+                    item = pipe.lindex(processing_key, -1)
+                    if item is None:
+                        break
+                    lane = pipe.hget(origin_key, item)
+                    if type(lane) == bytes:
+                        lane = lane.decode('utf-8')
+                    if lane not in LANES:
+                        lane = REALTIME
+                    pipe.multi()
+                    pipe.lmove(processing_key, self.lane_key(lane), 'RIGHT', 'LEFT')
+                    pipe.hdel(origin_key, item)
+                    pipe.execute()
+                    moved += 1
+                except redis.WatchError:
+                    continue
+        self._db.delete(origin_key)
+        return moved
+
+    def reap(self):
+        """ Requeue in-flight items from workers that stopped heartbeating.
+            Returns the count.
+        """
+        reaped = 0
+        for worker_id in self._db.smembers(self.workers_key):
+            if type(worker_id) == bytes:
+                worker_id = worker_id.decode('utf-8')
+            if worker_id == self.worker_id:
+                continue
+            if self._db.exists(self.heartbeat_key_for(worker_id)):
+                continue
+            reaped += self.requeue_in_flight(worker_id)
+            self._db.srem(self.workers_key, worker_id)
+        return reaped
+
+
+def open_queue(url, name, worker_id=None, weights=None, redis_host='localhost',
+               redis_port=6379):
+    """ Open a queue by URL.  "redis" (or None) uses Redis, and
+        "sqlite:<path>" a SQLite database shared by everything on one host.
+        Workers pass their worker_id to get a reliable queue.
+    """
+    if not url or url == 'redis':
+        if worker_id is None:
+            return RedisQueue(name, weights=weights, host=redis_host, port=redis_port)
+        return ReliableQueue(name, worker_id, weights=weights, host=redis_host,
+                             port=redis_port)
+
+    if url.startswith('sqlite:'):
+        from .sqlitequeue import SQLiteQueue
+        path = url[len('sqlite:'):]
+        if path.startswith('//'):
+            path = path[2:]
+        return SQLiteQueue(name, path, worker_id=worker_id, weights=weights)
+
+    raise ValueError("Unknown queue {}".format(url))
@@ -0,0 +1,78 @@
+""" Chain reorganization tracking """
+from collections import OrderedDict
+
+# Blocks behind the head we keep track of.  Reorgs deeper than this can't be
+# unwound.
+REORG_WINDOW = 128
+
+
+class ReorgTracker(object):
+    """ Remembers the hashes of recently scanned blocks and the IPFS hashes
+        queued from them so a reorg can be detected and unwound
+    """
+    def __init__(self, window=REORG_WINDOW):
+        self.window = window
+        # Block number -> block hash, oldest first
+        self.blocks = OrderedDict()
+        # Block number -> IPFS hashes queued from it
+        self.queued = {}
+        # Blocks at or after this get their queued hashes tracked
+        self.track_from = 0
+        # IPFS hashes taken off of the queue by a rewind -> the head when
+        # they were.  They have to be queued again wherever they turn up,
+        # even though we've seen them before.
+        self.orphaned = {}
+        self.head = 0
+
+    def set_head(self, head):
+        """ Forget blocks that have fallen out of the window """
+        self.head = head
+        self.track_from = max(0, head - self.window)
+        for number in list(self.blocks.keys()):
+            if number >= self.track_from:
+                break
+            del self.blocks[number]
+        for number in [x for x in self.queued if x < self.track_from]:
+            del self.queued[number]
+        # Orphaned hashes that haven't been mined again within the window
+        # most likely never will be
+        for file_hash in [x for x, at in self.orphaned.items() if at < self.track_from]:
+            del self.orphaned[file_hash]
+
+    def record_block(self, number, block_hash):
+        if number < self.track_from:
+            return
+        self.blocks.pop(number, None)
+        self.blocks[number] = block_hash
+
+    def record_hashes(self, number, hashes):
+        if number < self.track_from or not hashes:
+            return
+        self.queued.setdefault(number, []).extend(hashes)
+
+    def recorded(self):
+        """ (number, hash) of recorded blocks, newest first """
+        return list(reversed(self.blocks.items()))
+
+    def oldest(self):
+        for number in self.blocks:
+            return number
+        return None
+
+    def rewind(self, fork_block):
+        """ Forget everything after fork_block.  Returns the IPFS hashes that
+            were queued from the orphaned blocks.
+        """
+        orphaned = []
+        for number in [x for x in self.queued if x > fork_block]:
+            orphaned.extend(self.queued.pop(number))
+        for number in [x for x in self.blocks if x > fork_block]:
+            del self.blocks[number]
+        for file_hash in orphaned:
+            self.orphaned[file_hash] = self.head
+        return orphaned
+
+    def requeued(self, hashes):
+        """ Forget orphaned hashes once they're back on the queue """
+        for file_hash in hashes:
+            self.orphaned.pop(file_hash, None)
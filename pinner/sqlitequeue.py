@@ -0,0 +1,277 @@
+""" Durable queue in a SQLite database for running the listener and pinners on
+    a single host without going through Redis
+"""
+import time
+import sqlite3
+import threading
+from .ipfs import to_str
+from .queue import LaneQueue, LANES, REALTIME, RETRY, MAX_ATTEMPTS, RETRY_BACKOFF, \
+    RETRY_BACKOFF_MAX, HEARTBEAT_TTL, PUSH_CHUNK_SIZE
+
+# Item states
+PENDING = 0
+PROCESSING = 1
+SCHEDULED = 2
+DEAD = 3
+
+# Seconds between checks for new items while blocking on a pop
+POLL_INTERVAL = 0.05
+# Seconds to wait on another process holding the write lock
+BUSY_TIMEOUT = 30
+# Max host parameters in one statement on older SQLite builds
+MAX_VARIABLES = 999
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT NOT NULL,
+    lane TEXT NOT NULL,
+    item TEXT NOT NULL,
+    state INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    due REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS items_lane ON items (queue, state, lane, id);
+CREATE INDEX IF NOT EXISTS items_item ON items (queue, item);
+CREATE INDEX IF NOT EXISTS items_worker ON items (queue, worker, state);
+CREATE TABLE IF NOT EXISTS workers (
+    queue TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    heartbeat REAL NOT NULL,
+    PRIMARY KEY (queue, worker)
+);
+"""
+
+
+class SQLiteQueue(LaneQueue):
+    """ Queue kept in a SQLite database in WAL mode so that the listener and
+        pinner processes on one host can share it.  Items stay in the table
+        through processing, retries and dead-lettering, so it behaves like
+        ReliableQueue without the network round trips.  Workers must pass a
+        worker_id.  Blocking pops poll the database.
+    """
+    def __init__(self, name, path, worker_id=None, max_attempts=MAX_ATTEMPTS,
+                 backoff=RETRY_BACKOFF, max_backoff=RETRY_BACKOFF_MAX,
+                 heartbeat_ttl=HEARTBEAT_TTL, weights=None):
+        super(SQLiteQueue, self).__init__(weights=weights)
+        self.name = name
+        self.path = path
+        self.worker_id = worker_id
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.heartbeat_ttl = heartbeat_ttl
+        # One connection per thread
+        self.local = threading.local()
+        self.db.executescript(SCHEMA)
+        # Register right away so our items can be reaped even if we die
+        # before the first maintenance pass
+        if self.worker_id is not None:
+            self.heartbeat()
+
+    @property
+    def db(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def transaction(self):
+        """ Write transaction that takes the lock up front """
+        return Transaction(self.db)
+
+    def lane_sizes(self, limit=None):
+        """ Items waiting on each lane, counting no further than limit """
+        sizes = {}
+        for lane in LANES:
+            if limit is None:
+                query = 'SELECT COUNT(*) FROM items WHERE queue = ? AND state = ? AND lane = ?'
+                params = (self.name, PENDING, lane)
+            else:
+                query = ('SELECT COUNT(*) FROM (SELECT 1 FROM items WHERE queue = ? AND state = ? '
+                         'AND lane = ? LIMIT ?)')
+                params = (self.name, PENDING, lane, limit)
+            sizes[lane] = self.db.execute(query, params).fetchone()[0]
+        return sizes
+
+    def qsize(self, lane=None):
+        if lane is not None:
+            return self.lane_sizes()[lane]
+        return self.count(PENDING)
+
+    def count(self, state, worker=None):
+        query = 'SELECT COUNT(*) FROM items WHERE queue = ? AND state = ?'
+        params = [self.name, state]
+        if worker is not None:
+            query += ' AND worker = ?'
+            params.append(worker)
+        return self.db.execute(query, params).fetchone()[0]
+
+    def append(self, item, lane=REALTIME):
+        self.append_many([item], lane=lane)
+
+    def append_many(self, items, lane=REALTIME):
+        if lane not in LANES:
+            raise ValueError("Unknown queue lane {}".format(lane))
+        items = list(items)
+        if not items:
+            return
+        with self.transaction() as db:
+            db.executemany('INSERT INTO items (queue, lane, item) VALUES (?, ?, ?)',
+                           [(self.name, lane, to_str(x)) for x in items])
+
+    def remove_many(self, items):
+        """ Remove pending items from every lane.  Returns the count removed. """
+        items = [to_str(x) for x in items]
+        removed = 0
+        chunk_size = MAX_VARIABLES - 2
+        with self.transaction() as db:
+            for i in range(0, len(items), chunk_size):
+                chunk = items[i:i + chunk_size]
+                removed += db.execute(
+                    'DELETE FROM items WHERE queue = ? AND state = ? AND item IN ({})'.format(
+                        ','.join('?' * len(chunk))),
+                    [self.name, PENDING] + chunk).rowcount
+        return removed
+
+    def pop(self, block=True, timeout=None):
+        items = self.pop_many(1, block=block, timeout=timeout)
+        if items:
+            return items[0]
+        return None
+
+    def pop_many(self, count, block=True, timeout=None):
+        """ Mark up to count items, shared between the lanes by weight, as ours.
+            If block is set and a timeout is given, poll for up to timeout
+            seconds (forever if it's 0) for the first one.
+        """
+        if not timeout:
+            deadline = None
+        else:
+            deadline = time.time() + timeout
+        block = block and timeout is not None
+        while True:
+            items = []
+            # Idle workers only read, so they don't hold up the writers
+            if any(self.lane_sizes(limit=1).values()):
+                with self.transaction() as db:
+                    plan = self.schedule(count, self.lane_sizes(limit=count))
+                    for lane, pops in plan.items():
+                        if not pops:
+                            continue
+                        rows = db.execute('SELECT id, item FROM items WHERE queue = ? '
+                                          'AND state = ? AND lane = ? ORDER BY id LIMIT ?',
+                                          (self.name, PENDING, lane, pops)).fetchall()
+                        db.executemany('UPDATE items SET state = ?, worker = ? WHERE id = ?',
+                                       [(PROCESSING, self.worker_id, row[0]) for row in rows])
+                        items.extend(row[1] for row in rows)
+
+            if items or not block or (deadline is not None and time.time() >= deadline):
+                return items
+            time.sleep(POLL_INTERVAL)
+
+    def in_flight(self):
+        return self.count(PROCESSING, worker=self.worker_id)
+
+    def processing_row(self, db, item):
+        """ (id, attempts) of an item we're processing """
+        return db.execute('SELECT id, attempts FROM items WHERE queue = ? AND state = ? '
+                          'AND worker = ? AND item = ? LIMIT 1',
+                          (self.name, PROCESSING, self.worker_id, to_str(item))).fetchone()
+
+    def ack(self, item):
+        """ Mark an item as done """
+        with self.transaction() as db:
+            row = self.processing_row(db, item)
+            if row is not None:
+                db.execute('DELETE FROM items WHERE id = ?', (row[0],))
+
+    def fail(self, item):
+        """ Schedule an item for a delayed retry, or dead-letter it if it has
+            used up its attempts.  Returns True if it will be retried.
+        """
+        with self.transaction() as db:
+            row = self.processing_row(db, item)
+            if row is None:
+                return False
+            item_id, attempts = row[0], row[1] + 1
+            if attempts >= self.max_attempts:
+                db.execute('UPDATE items SET state = ?, worker = NULL, attempts = ? WHERE id = ?',
+                           (DEAD, attempts, item_id))
+                return False
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            db.execute('UPDATE items SET state = ?, worker = NULL, attempts = ?, due = ? '
+                       'WHERE id = ?', (SCHEDULED, attempts, time.time() + delay, item_id))
+            return True
+
+    def attempts(self, items):
+        """ Times each item we're processing has failed so far """
+        rows = [self.processing_row(self.db, x) for x in items]
+        return [row[1] if row is not None else 0 for row in rows]
+
+    def retry_size(self):
+        return self.count(SCHEDULED)
+
+    def dead_size(self):
+        return self.count(DEAD)
+
+    def promote_retries(self, limit=PUSH_CHUNK_SIZE):
+        """ Move retries that are due onto the retry lane.  Returns the count. """
+        with self.transaction() as db:
+            return db.execute('UPDATE items SET state = ?, lane = ? WHERE id IN '
+                              '(SELECT id FROM items WHERE queue = ? AND state = ? AND due <= ? '
+                              'LIMIT ?)',
+                              (PENDING, RETRY, self.name, SCHEDULED, time.time(), limit)).rowcount
+
+    def heartbeat(self):
+        """ Let the other workers know we're alive """
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO workers (queue, worker, heartbeat) VALUES (?, ?, ?)',
+                       (self.name, self.worker_id, time.time()))
+
+    def requeue_in_flight(self, worker_id=None):
+        """ Put everything a worker is processing back on the lane it was
+            popped from.  Returns the count.
+        """
+        with self.transaction() as db:
+            return db.execute('UPDATE items SET state = ?, worker = NULL '
+                              'WHERE queue = ? AND worker = ? AND state = ?',
+                              (PENDING, self.name, worker_id or self.worker_id,
+                               PROCESSING)).rowcount
+
+    def reap(self):
+        """ Requeue in-flight items from workers that stopped heartbeating.
+            Returns the count.
+        """
+        expired = self.db.execute('SELECT worker FROM workers WHERE queue = ? AND worker != ? '
+                                  'AND heartbeat < ?',
+                                  (self.name, self.worker_id,
+                                   time.time() - self.heartbeat_ttl)).fetchall()
+        reaped = 0
+        for row in expired:
+            reaped += self.requeue_in_flight(row[0])
+            with self.transaction() as db:
+                db.execute('DELETE FROM workers WHERE queue = ? AND worker = ?',
+                           (self.name, row[0]))
+        return reaped
+
+
+class Transaction(object):
+    """ BEGIN IMMEDIATE ... COMMIT, rolling back on errors """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
@@ -9,7 +9,13 @@ setuptools.setup(name='pinner',
     url='http://github.com/mikeshultz/ethereum-pinner',
     packages=['pinner'],
     data_files=['README.md'],
-    install_requires=['redis>=2.10.6', 'pycryptodome==3.6.6', 'eth-abi>=0.5.0', 'eth-utils>=0.7.4', 'jsonrpc-requests>=0.4.0', 'base58==1.0.0', 'ipfsapi==0.4.2.post1'],
+    install_requires=['redis>=4.0.0', 'pycryptodome==3.6.6', 'eth-abi>=0.5.0', 'eth-utils>=0.7.4', 'jsonrpc-requests>=0.4.0', 'base58==1.0.0'],
+    extras_require={
+        'ws': ['websocket-client>=0.54.0'],
+        'metrics': ['prometheus_client>=0.7.0'],
+        'bench': ['fakeredis>=1.7.0'],
+        'test': ['fakeredis>=1.7.0', 'pytest'],
+    },
     license='GPLv3',
     zip_safe=False,
     keywords='ethereum ipfs',
@@ -17,7 +23,7 @@ setuptools.setup(name='pinner',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Operating System :: POSIX',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Topic :: System :: Distributed Computing',
     ],
     entry_points = {
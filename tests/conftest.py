@@ -0,0 +1,30 @@
+""" Fixtures shared by the tests.  Redis, IPFS and the JSON-RPC provider are
+    the stand-ins from the benchmark suite, so nothing outside of the test
+    process is needed.
+"""
+import pytest
+import redis
+from bench.fakes import use_fake_redis
+
+
+@pytest.fixture(autouse=True)
+def fake_redis():
+    """ Give every test its own empty in-memory Redis """
+    connect = redis.Redis
+    server = use_fake_redis()
+    yield server
+    redis.Redis = connect
+
+
+@pytest.fixture
+def start_chain():
+    """ Start a FakeChain, or a subclass of it, that's stopped after the test """
+    chains = []
+
+    def start(chain):
+        chains.append(chain.start())
+        return chain
+
+    yield start
+    for chain in chains:
+        chain.stop()
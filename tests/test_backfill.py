@@ -0,0 +1,180 @@
+import threading
+import time
+from bench.fakes import FakeChain, contract_config
+from pinner.listener import ContractListener, BACKFILL_RETRIES
+from pinner.pipeline import DecodePipeline
+
+
+class LimitedChain(FakeChain):
+    """ Provider that refuses log requests for more than max_blocks blocks """
+    def __init__(self, max_blocks, **kwargs):
+        super(LimitedChain, self).__init__(**kwargs)
+        self.max_blocks = max_blocks
+        self.served = []
+
+    def handle(self, request):
+        if request['method'] == 'eth_getLogs':
+            log_filter = request['params'][0]
+            block_range = (int(log_filter['fromBlock'], 16), int(log_filter['toBlock'], 16))
+            if block_range[1] - block_range[0] + 1 > self.max_blocks:
+                return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {
+                    'code': -32005,
+                    'message': 'query returned more than 10000 results'}}
+            self.served.append(block_range)
+        return super(LimitedChain, self).handle(request)
+
+
+class FlakyChain(FakeChain):
+    """ Provider whose log requests fail with error while failing(from, to)
+        says so
+    """
+    def __init__(self, failing, error, **kwargs):
+        super(FlakyChain, self).__init__(**kwargs)
+        self.failing = failing
+        self.error = error
+        self.ranges = []
+
+    def handle(self, request):
+        if request['method'] == 'eth_getLogs':
+            log_filter = request['params'][0]
+            block_range = (int(log_filter['fromBlock'], 16), int(log_filter['toBlock'], 16))
+            self.ranges.append(block_range)
+            if self.failing(*block_range):
+                return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': self.error}
+        return super(FlakyChain, self).handle(request)
+
+
+class CountingChain(FakeChain):
+    """ Provider that remembers the most log requests it had in flight at
+        once
+    """
+    def __init__(self, **kwargs):
+        super(CountingChain, self).__init__(**kwargs)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most = 0
+
+    def handle(self, request):
+        if request['method'] != 'eth_getLogs':
+            return super(CountingChain, self).handle(request)
+        with self.lock:
+            self.active += 1
+            self.most = max(self.most, self.active)
+        try:
+            time.sleep(0.01)
+            return super(CountingChain, self).handle(request)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def make_listener(chain, chunk_size=100, concurrency=None, address=None):
+    contract = contract_config()
+    contract['backfillChunkSize'] = chunk_size
+    if concurrency is not None:
+        contract['backfillConcurrency'] = concurrency
+    if address is not None:
+        contract['address'] = address
+    return ContractListener(contract, chain.url, pipeline=DecodePipeline(processes=1))
+
+
+def checkpointed(listener):
+    return listener.checkpoints.get(listener.contract['address'], listener.events)
+
+
+def test_scans_every_block(start_chain):
+    chain = start_chain(FakeChain(head=999, logs_per_block=2))
+    listener = make_listener(chain)
+    assert listener.backfill.run(0, 999) == 2000
+    assert listener.queue.qsize() == 2000
+    assert len(set(listener.queue._db.lrange(listener.queue.key, 0, -1))) == 2000
+    assert checkpointed(listener) == 999
+
+
+def test_splits_ranges_with_too_many_results(start_chain):
+    chain = start_chain(LimitedChain(30, head=999, logs_per_block=1))
+    listener = make_listener(chain, chunk_size=1000)
+    assert listener.backfill.run(0, 999) == 1000
+    assert listener.queue.qsize() == 1000
+    assert checkpointed(listener) == 999
+    # Split down until they fit, covering every block once
+    served = sorted(chain.served)
+    assert served[0][0] == 0 and served[-1][1] == 999
+    assert all(a[1] + 1 == b[0] for a, b in zip(served, served[1:]))
+
+
+def test_retries_errors_without_splitting(start_chain):
+    calls = []
+
+    def failing(from_block, to_block):
+        calls.append(from_block)
+        return calls.count(from_block) <= 2
+
+    for error in [{'code': -32005, 'message': 'project ID request rate exceeded'},
+                  {'code': -32000, 'message': 'request timed out'}]:
+        chain = start_chain(FlakyChain(failing, error, head=999, logs_per_block=1))
+        listener = make_listener(chain)
+        assert listener.backfill.run(0, 999) == 1000
+        assert listener.backfill.chunk_size == 100
+        assert all(to_block - from_block == 99 for from_block, to_block in chain.ranges)
+        del calls[:]
+
+
+def test_failures_back_off_concurrency(start_chain):
+    chain = start_chain(FlakyChain(lambda *x: True, {'code': 429, 'message': 'Too Many Requests'},
+                                   head=999))
+    listener = make_listener(chain)
+    before = listener.backfill.limit.limit
+    assert listener.backfill.run(0, 999) == 0
+    assert listener.backfill.limit.limit < before
+
+
+def test_shares_limit_per_provider(start_chain):
+    chain = start_chain(FakeChain())
+    other = start_chain(FakeChain())
+    first = make_listener(chain)
+    assert make_listener(chain).backfill.limit is first.backfill.limit
+    assert make_listener(other).backfill.limit is not first.backfill.limit
+
+
+def test_shared_limit_caps_every_backfill(start_chain):
+    chain = start_chain(CountingChain(head=999, logs_per_block=1))
+    listeners = [make_listener(chain, chunk_size=10, concurrency=2),
+                 make_listener(chain, chunk_size=10, concurrency=2, address='0x' + '33' * 20),
+                 make_listener(chain, chunk_size=10, concurrency=2, address='0x' + '44' * 20)]
+    found = []
+    threads = [threading.Thread(target=lambda x: found.append(x.backfill.run(0, 999)), args=(x,))
+               for x in listeners]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert found == [1000] * 3
+    assert chain.most == 2
+    assert listeners[0].backfill.limit.in_use == 0
+
+
+def test_shared_limit_is_the_largest_asked_for(start_chain):
+    chain = start_chain(FakeChain())
+    first = make_listener(chain, concurrency=2)
+    assert first.backfill.limit.limit == 2
+    make_listener(chain, concurrency=6)
+    assert first.backfill.limit.limit == 6
+    make_listener(chain, concurrency=3)
+    assert first.backfill.limit.limit == 6
+
+
+def test_checkpoint_stops_at_a_gap(start_chain):
+    # Blocks 500-599 never come back, so nothing past 499 can be checkpointed
+    # even though later ranges were scanned
+    chain = start_chain(FlakyChain(lambda from_block, to_block: from_block <= 500 <= to_block,
+                                   {'code': -32000, 'message': 'internal error'},
+                                   head=999, logs_per_block=1))
+    listener = make_listener(chain)
+    checkpoints = []
+    listener.checkpoint = lambda number: checkpoints.append(number)
+
+    listener.backfill.run(0, 999)
+    assert checkpoints == sorted(checkpoints)
+    assert checkpoints[-1] == 499
+    assert chain.ranges.count((500, 599)) == BACKFILL_RETRIES + 1
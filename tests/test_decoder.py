@@ -0,0 +1,100 @@
+from eth_abi import encode_abi
+from eth_utils import encode_hex
+from bench.fakes import EVENT_ABI, make_logs
+from pinner.decoder import EventDecoder
+
+MIXED_ABI = {
+    "anonymous": False,
+    "inputs": [
+        {"indexed": True, "name": "id", "type": "uint256"},
+        {"indexed": True, "name": "tag", "type": "bytes32"},
+        {"indexed": False, "name": "hash", "type": "bytes32"},
+        {"indexed": False, "name": "size", "type": "uint64"},
+        {"indexed": False, "name": "count", "type": "uint"},
+    ],
+    "name": "Stored",
+    "type": "event",
+}
+
+
+def slow_decoder(abi):
+    """ Decoder that always goes through eth_abi """
+    decoder = EventDecoder(abi)
+    for plan in decoder.plans.values():
+        plan['fast'] = None
+    return decoder
+
+
+def test_fast_path_matches_eth_abi():
+    logs = make_logs(200)
+    fast = EventDecoder([EVENT_ABI])
+    assert all(x['fast'] is not None for x in fast.plans.values())
+    decoded = fast.process_logs(logs)
+    assert len(decoded) == 200
+    assert decoded == slow_decoder([EVENT_ABI]).process_logs(logs)
+
+
+def test_fast_path_matches_eth_abi_for_mixed_types():
+    decoder = EventDecoder([MIXED_ABI])
+    topic = decoder.topics[0].decode('utf-8')
+    logs = []
+    for i in range(0, 50):
+        data = encode_abi(['bytes32', 'uint64', 'uint256'],
+                          [bytes([i]) * 32, 2 ** 64 - 1 - i, 3 ** i])
+        logs.append({
+            "topics": [topic, '0x%064x' % i, '0x' + ('%02x' % i) * 32],
+            "data": encode_hex(data),
+        })
+
+    decoded = decoder.process_logs(logs)
+    assert decoded == slow_decoder([MIXED_ABI]).process_logs(logs)
+    assert decoded[7]['args'] == {
+        'id': 7,
+        'tag': '0x' + '07' * 32,
+        'hash': '0x' + '07' * 32,
+        'size': 2 ** 64 - 8,
+        'count': 3 ** 7,
+    }
+
+
+def test_short_data_falls_back():
+    decoder = EventDecoder([EVENT_ABI])
+    log = make_logs(1)[0]
+    log['data'] = log['data'][:-2]
+    # Too short for the fast path, so eth_abi gets it and rejects it
+    assert decoder.process_logs([log]) == []
+
+
+def test_dynamic_types_use_eth_abi():
+    abi = {
+        "anonymous": False,
+        "inputs": [{"indexed": False, "name": "uri", "type": "string"}],
+        "name": "Uri",
+        "type": "event",
+    }
+    decoder = EventDecoder([abi])
+    assert all(x['fast'] is None for x in decoder.plans.values())
+    log = {"topics": [decoder.topics[0]], "data": encode_hex(encode_abi(['string'], ['ipfs://x']))}
+    assert decoder.process_logs([log]) == [{"name": "Uri", "args": {"uri": "ipfs://x"}}]
+
+
+def test_arrays_use_eth_abi():
+    abi = {
+        "anonymous": False,
+        "inputs": [
+            {"indexed": False, "name": "ids", "type": "uint256[2]"},
+            {"indexed": False, "name": "hash", "type": "bytes32"},
+            {"indexed": False, "name": "sizes", "type": "uint8[]"},
+        ],
+        "name": "Batch",
+        "type": "event",
+    }
+    decoder = EventDecoder([abi])
+    assert all(x['fast'] is None for x in decoder.plans.values())
+    data = encode_abi(['uint256[2]', 'bytes32', 'uint8[]'], [[5, 6], b'\xab' * 32, [1, 2, 3]])
+    log = {"topics": [decoder.topics[0]], "data": encode_hex(data)}
+    assert decoder.process_logs([log]) == [{"name": "Batch", "args": {
+        "ids": (5, 6),
+        "hash": '0x' + 'ab' * 32,
+        "sizes": (1, 2, 3),
+    }}]
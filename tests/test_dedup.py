@@ -0,0 +1,62 @@
+import pytest
+import redis
+from bench.fakes import contract_config
+from pinner.dedup import BloomFilter
+from pinner.listener import ContractListener
+from pinner.pipeline import DecodePipeline
+
+
+def test_add_many_counts_repeats_once():
+    bloom = BloomFilter('test', capacity=1000)
+    assert bloom.add_many(['a', 'b', 'a', 'c', 'b']) == [True, True, False, True, False]
+    assert bloom.add_many(['a', 'd']) == [False, True]
+
+
+def test_add_many_across_processes():
+    # A second filter has nothing in its recent cache, so it has to go by
+    # the bits in Redis
+    BloomFilter('test', capacity=1000).add_many(['a', 'b'])
+    other = BloomFilter('test', capacity=1000)
+    assert other.add_many(['a', 'c', 'c']) == [False, True, False]
+    assert 'b' in other
+
+
+def test_filter_new_does_not_add():
+    bloom = BloomFilter('test', capacity=1000)
+    bloom.add('a')
+    assert bloom.filter_new(['a', 'b', 'b', 'c']) == ['b', 'c']
+    assert bloom.contains_many(['a', 'b', 'c']) == [True, False, False]
+
+
+def test_clear():
+    bloom = BloomFilter('test', capacity=1000)
+    bloom.add_many(['a', 'b'])
+    bloom.clear()
+    assert 'a' not in bloom
+    assert BloomFilter('test', capacity=1000).filter_new(['a', 'b']) == ['a', 'b']
+
+
+def test_sizing():
+    bloom = BloomFilter('test', capacity=1000000, error_rate=0.01)
+    # About 9.6 bits and 7 hashes per item for a 1% false-positive rate
+    assert 9000000 < bloom.bits < 10000000
+    assert bloom.hashes == 7
+
+
+def test_listener_marks_hashes_once_queued():
+    bloom = BloomFilter('test', capacity=1000)
+    listener = ContractListener(contract_config(), 'http://127.0.0.1:1/', dedup=bloom,
+                                pipeline=DecodePipeline(processes=1))
+
+    def down(items, lane=None):
+        raise redis.ConnectionError("Redis is down")
+
+    listener.queue.append_many = down
+    with pytest.raises(redis.ConnectionError):
+        listener.pin_many(['QmA'])
+    assert 'QmA' not in bloom
+
+    del listener.queue.append_many
+    assert listener.pin_many(['QmA', 'QmA']) == ['QmA']
+    assert listener.pin_many(['QmA', 'QmB']) == ['QmB']
+    assert listener.queue.qsize() == 2
@@ -0,0 +1,81 @@
+import base58
+import pytest
+from bench.fakes import contract_config, make_logs, content_hash, ipfs_hash
+from pinner.hashes import sha256_cidv0, sha256_cidv1, multihash_cid, string_cid, normalizer, \
+    encode_varint, decode_varint, is_cid, CODECS
+from pinner.pipeline import decode_chunk
+
+# The same content as a CIDv0 and a base32 dag-pb CIDv1
+CIDV0 = 'QmbWqxBEKC3P8tqsKc98xmWNzrzDtRLMiMPL8wBuTGsMnR'
+CIDV1 = 'bafybeigdyrzt5sfp7udm7hu76uh7y26nf3efuylqabf3oclgtqy55fbzdi'
+DIGEST = '0x' + base58.b58decode(CIDV0)[2:].hex()
+
+
+def test_sha256():
+    assert sha256_cidv0(DIGEST) == CIDV0
+    assert sha256_cidv0(bytes.fromhex(DIGEST[2:])) == CIDV0
+
+
+def test_cidv1():
+    assert sha256_cidv1(DIGEST) == CIDV1
+    raw = sha256_cidv1(DIGEST, CODECS['raw'])
+    assert raw.startswith('bafkrei')
+    assert is_cid(raw)
+
+
+def test_invalid_digests():
+    assert sha256_cidv0('0x' + '00' * 32) is None
+    assert sha256_cidv0('0x' + 'ab' * 31) is None
+    assert sha256_cidv0('0xnothex') is None
+    assert sha256_cidv1('0x' + '00' * 32) is None
+
+
+def test_multihash():
+    assert multihash_cid('0x1220' + DIGEST[2:]) == CIDV0
+    # Other hash functions need a CIDv1.  0xb220 is blake2b-256.
+    blake = multihash_cid('0x' + encode_varint(0xb220).hex() + '20' + 'cd' * 32)
+    assert blake.startswith('b')
+    assert is_cid(blake)
+    # Length that doesn't match the digest
+    assert multihash_cid('0x1220' + 'ab' * 31) is None
+    assert multihash_cid('0x') is None
+
+
+def test_string_cid():
+    assert string_cid(CIDV0) == CIDV0
+    assert string_cid(' %s\n' % CIDV1) == CIDV1
+    assert string_cid(CIDV1.encode('utf-8')) == CIDV1
+    assert string_cid(CIDV0[:-1]) is None
+    assert string_cid('ipfs://' + CIDV0) is None
+    assert string_cid(b'\xff') is None
+
+
+def test_varint():
+    for value in [0, 1, 127, 128, 0x70, 0xb220, 2 ** 40]:
+        assert decode_varint(encode_varint(value)) == (value, len(encode_varint(value)))
+    with pytest.raises(ValueError):
+        decode_varint(b'\x80')
+
+
+def test_normalizer():
+    assert normalizer({'name': 'Post'}) is sha256_cidv0
+    assert normalizer({'name': 'Post', 'hashFormat': 'cidv1'})(DIGEST) == CIDV1
+    assert normalizer({'name': 'Post', 'hashFormat': 'cidv1', 'codec': 'raw'})(DIGEST) == \
+        sha256_cidv1(DIGEST, CODECS['raw'])
+    with pytest.raises(ValueError):
+        normalizer({'name': 'Post', 'hashFormat': 'md5'})
+    with pytest.raises(ValueError):
+        normalizer({'name': 'Post', 'hashFormat': 'cidv1', 'codec': 'git'})
+
+
+def test_decode_with_format():
+    logs = make_logs(20)
+    contract = contract_config()
+    assert decode_chunk(contract, logs) == \
+        [ipfs_hash(content_hash(i // 10, i % 10)) for i in range(0, 20)]
+
+    contract = contract_config()
+    contract['address'] = '0x' + '11' * 20
+    contract['events'][0]['hashFormat'] = 'cidv1'
+    assert decode_chunk(contract, logs) == \
+        [sha256_cidv1('0x' + content_hash(i // 10, i % 10)) for i in range(0, 20)]
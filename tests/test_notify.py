@@ -0,0 +1,46 @@
+import time
+from bench.fakes import FakeChain
+from pinner import notify
+from pinner.jsonrpc import JSONRPCClient
+from pinner.notify import BlockNotifier
+
+
+class BreakingChain(FakeChain):
+    """ Provider whose block filter starts returning garbage once broken """
+    def __init__(self, **kwargs):
+        super(BreakingChain, self).__init__(**kwargs)
+        self.broken = False
+
+    def handle(self, request):
+        if self.broken and request['method'] == 'eth_getFilterChanges':
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': ['0x1']}
+        if self.broken and request['method'] == 'eth_blockNumber':
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': None}
+        return super(BreakingChain, self).handle(request)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_filter_failure_falls_back_to_polling(start_chain, monkeypatch):
+    monkeypatch.setattr(notify, 'FILTER_INTERVAL', 0.01)
+    monkeypatch.setattr(notify, 'RESUBSCRIBE_DELAY', 0.5)
+    chain = start_chain(BreakingChain(head=100))
+    notifier = BlockNotifier(JSONRPCClient(chain.url)).start()
+    try:
+        wait_for(lambda: notifier.subscribed and notifier.head == 100)
+
+        chain.broken = True
+        wait_for(lambda: not notifier.subscribed)
+
+        # and the thread lives on to subscribe again once the provider recovers
+        chain.broken = False
+        chain.head = 101
+        wait_for(lambda: notifier.subscribed and notifier.head == 101)
+        assert notifier.thread.is_alive()
+    finally:
+        notifier.stop()
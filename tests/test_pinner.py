@@ -0,0 +1,84 @@
+import time
+import pytest
+from bench.fakes import FakeIPFS
+from pinner.ipfs import IPFSError
+from pinner.pinner import Pinner
+
+
+@pytest.fixture
+def ipfs():
+    node = FakeIPFS(delay=0.05).start()
+    yield node
+    node.stop()
+
+
+def pin_queued(pinner, hashes):
+    """ Queue hashes and run them through the pinner as one batch """
+    pinner.queue.append_many(hashes)
+    messages = pinner.queue.pop_many(len(hashes))
+    pinner.pin(messages, pinner.cluster.holders(messages))
+
+
+def test_pins_batch(ipfs):
+    pinner = Pinner('127.0.0.1', ipfs.port, batch_size=4, stall_timeout=2)
+    hashes = ['QmA', 'QmB', 'QmC', 'QmD']
+    pin_queued(pinner, hashes)
+    assert ipfs.pinned == set(hashes)
+    assert pinner.queue.in_flight() == 0
+    assert pinner.queue.retry_size() == 0
+    assert pinner.cluster.nodes[0].pins.contains_many(hashes) == [True] * 4
+
+
+def test_stalled_batch_is_requeued(ipfs):
+    ipfs.failure_rate = 1
+    pinner = Pinner('127.0.0.1', ipfs.port, batch_size=4, stall_timeout=1)
+    start = time.time()
+    pin_queued(pinner, ['QmA', 'QmB', 'QmC', 'QmD'])
+    # One stalled request, not one per hash
+    assert time.time() - start < 4
+    assert ipfs.pinned == set()
+    assert pinner.queue.in_flight() == 0
+    assert pinner.queue.retry_size() == 4
+
+
+def test_named_failure_pins_the_rest(ipfs):
+    pinner = Pinner('127.0.0.1', ipfs.port, batch_size=4, stall_timeout=2)
+    node = pinner.cluster.nodes[0]
+    pin = node.pin
+    requests = []
+
+    def pin_unless_bad(hashes, **kwargs):
+        requests.append([x.decode('utf-8') for x in hashes])
+        if b'QmBad' in hashes:
+            raise IPFSError("pin: failed to resolve /ipfs/QmBad: not found")
+        return pin(hashes, **kwargs)
+
+    node.pin = pin_unless_bad
+    pin_queued(pinner, ['QmA', 'QmBad', 'QmC'])
+    assert requests == [['QmA', 'QmBad', 'QmC'], ['QmA', 'QmC']]
+    assert ipfs.pinned == {'QmA', 'QmC'}
+    assert pinner.queue.retry_size() == 1
+
+
+def test_pin_seconds_per_request(ipfs):
+    prometheus_client = pytest.importorskip('prometheus_client')
+    pinner = Pinner('127.0.0.1', ipfs.port, batch_size=3, stall_timeout=2)
+    labels = {'node': pinner.cluster.nodes[0].name, 'batch_size': '3'}
+    before = prometheus_client.REGISTRY.get_sample_value('pinner_pin_seconds_count', labels) or 0
+    pin_queued(pinner, ['QmA', 'QmB', 'QmC'])
+    assert prometheus_client.REGISTRY.get_sample_value('pinner_pin_seconds_count', labels) == \
+        before + 1
+
+
+def test_retried_hashes_are_pinned_alone(ipfs):
+    pinner = Pinner('127.0.0.1', ipfs.port, batch_size=4, stall_timeout=2)
+    pinner.queue.backoff = 0
+    pinner.queue.append('QmDead')
+    pinner.queue.fail(pinner.queue.pop())
+    pinner.queue.promote_retries()
+    pinner.queue.append_many(['QmA', 'QmB', 'QmC'])
+
+    messages = pinner.queue.pop_many(4)
+    batches = pinner.batches(messages, pinner.cluster.holders(messages))
+    assert sorted([x.decode('utf-8') for x in chunk] for chunk, holders in batches) == \
+        [['QmA', 'QmB', 'QmC'], ['QmDead']]
@@ -0,0 +1,163 @@
+import time
+import threading
+import redis
+from pinner.queue import LaneQueue, ReliableQueue, REALTIME, BACKFILL, RETRY
+
+
+def test_ack_drops_item():
+    queue = ReliableQueue('test', 'w1')
+    queue.append_many(['a', 'b'])
+    assert queue.pop_many(2) == [b'a', b'b']
+    assert queue.in_flight() == 2
+
+    queue.ack(b'a')
+    assert queue.in_flight() == 1
+    assert queue.qsize() == 0
+    assert queue.retry_size() == 0
+
+
+def test_fail_schedules_retry():
+    queue = ReliableQueue('test', 'w1', backoff=0)
+    queue.append('a')
+    item = queue.pop()
+    assert queue.fail(item)
+    assert queue.in_flight() == 0
+    assert queue.retry_size() == 1
+
+    assert queue.promote_retries() == 1
+    assert queue.retry_size() == 0
+    assert queue.qsize(RETRY) == 1
+    assert queue.pop() == b'a'
+    assert queue.attempts([b'a', b'b']) == [1, 0]
+
+
+def test_fail_waits_for_backoff():
+    queue = ReliableQueue('test', 'w1', backoff=60)
+    queue.append('a')
+    queue.fail(queue.pop())
+    assert queue.promote_retries() == 0
+    assert queue.retry_size() == 1
+
+
+def test_fail_dead_letters_after_max_attempts():
+    queue = ReliableQueue('test', 'w1', backoff=0, max_attempts=2)
+    queue.append('a')
+    assert queue.fail(queue.pop())
+    queue.promote_retries()
+    assert not queue.fail(queue.pop())
+    assert queue.dead_size() == 1
+    assert queue.retry_size() == 0
+    assert queue.qsize() == 0
+
+
+def test_ack_resets_attempts():
+    queue = ReliableQueue('test', 'w1', backoff=0, max_attempts=2)
+    queue.append('a')
+    queue.fail(queue.pop())
+    queue.promote_retries()
+    queue.ack(queue.pop())
+
+    # Queued again later, it gets all of its attempts back
+    queue.append('a')
+    assert queue.fail(queue.pop())
+
+
+def test_reap_requeues_dead_worker():
+    dead = ReliableQueue('test', 'w1')
+    alive = ReliableQueue('test', 'w2')
+    dead.heartbeat()
+    alive.heartbeat()
+    dead.append_many(['a', 'b', 'c'])
+    assert dead.pop_many(2) == [b'a', b'b']
+
+    # Nothing to reap while the worker is heartbeating
+    assert alive.reap() == 0
+
+    redis.Redis().delete(dead.heartbeat_key)
+    assert alive.reap() == 2
+    assert dead.in_flight() == 0
+    # Back at the front, in the order they were popped
+    assert alive.pop_many(3) == [b'a', b'b', b'c']
+    # And the dead worker is forgotten
+    assert alive.reap() == 0
+
+
+def test_reap_skips_self():
+    queue = ReliableQueue('test', 'w1')
+    queue.heartbeat()
+    queue.append('a')
+    queue.pop()
+    redis.Redis().delete(queue.heartbeat_key)
+    assert queue.reap() == 0
+    assert queue.in_flight() == 1
+
+
+def test_requeue_in_flight():
+    queue = ReliableQueue('test', 'w1')
+    queue.append_many(['a', 'b'])
+    queue.pop_many(2)
+    queue.append('c')
+    assert queue.requeue_in_flight() == 2
+    assert queue.in_flight() == 0
+    assert queue.pop_many(3) == [b'a', b'b', b'c']
+
+
+def test_pop_without_timeout_does_not_block():
+    queue = ReliableQueue('test', 'w1')
+    start = time.time()
+    assert queue.pop() is None
+    assert queue.pop_many(5) == []
+    assert time.time() - start < 1
+
+
+def test_pop_waits_for_timeout():
+    queue = ReliableQueue('test', 'w1')
+    start = time.time()
+    assert queue.pop(timeout=0.3) is None
+    assert time.time() - start >= 0.3
+
+
+def test_schedule_shares_by_weight():
+    lanes = LaneQueue()
+    sizes = {REALTIME: 100, BACKFILL: 100, RETRY: 100}
+    assert lanes.schedule(11, sizes) == {REALTIME: 8, BACKFILL: 2, RETRY: 1}
+
+
+def test_schedule_skips_empty_lanes():
+    lanes = LaneQueue()
+    assert lanes.schedule(5, {REALTIME: 0, BACKFILL: 3, RETRY: 1}) == \
+        {REALTIME: 0, BACKFILL: 3, RETRY: 1}
+
+
+def test_schedule_carries_credit_between_pops():
+    lanes = LaneQueue(weights={REALTIME: 3, BACKFILL: 1, RETRY: 1})
+    sizes = {REALTIME: 100, BACKFILL: 100, RETRY: 100}
+    totals = {REALTIME: 0, BACKFILL: 0, RETRY: 0}
+    for i in range(0, 50):
+        for lane, pops in lanes.schedule(1, sizes).items():
+            totals[lane] += pops
+    assert totals == {REALTIME: 30, BACKFILL: 10, RETRY: 10}
+
+
+def test_pop_many_shares_lanes():
+    queue = ReliableQueue('test', 'w1')
+    queue.append_many(['r%s' % i for i in range(0, 20)], lane=REALTIME)
+    queue.append_many(['b%s' % i for i in range(0, 20)], lane=BACKFILL)
+    items = queue.pop_many(10)
+    assert sorted(items) == [b'b0', b'b1'] + [('r%s' % i).encode('utf-8') for i in range(0, 8)]
+
+
+def test_pop_waits_on_every_lane():
+    queue = ReliableQueue('test', 'w1')
+    threading.Timer(0.2, queue.append, ['b'], {'lane': BACKFILL}).start()
+    assert queue.pop(timeout=5) == b'b'
+
+
+def test_requeue_returns_items_to_their_lane():
+    queue = ReliableQueue('test', 'w1')
+    queue.append('r', lane=REALTIME)
+    queue.append('b', lane=BACKFILL)
+    queue.append('t', lane=RETRY)
+    assert sorted(queue.pop_many(3)) == [b'b', b'r', b't']
+    assert queue.requeue_in_flight() == 3
+    assert queue.lane_sizes() == {REALTIME: 1, BACKFILL: 1, RETRY: 1}
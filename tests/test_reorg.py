@@ -0,0 +1,176 @@
+from bench.fakes import FakeChain, contract_config, make_log
+from pinner.dedup import BloomFilter
+from pinner.listener import ContractListener, MultiContractListener
+from pinner.pipeline import DecodePipeline
+from pinner.reorg import ReorgTracker
+
+
+class ForkingChain(FakeChain):
+    """ Chain whose blocks after fork get new hashes, and that can pretend
+        not to know about some blocks.  Once forked, blocks in moved carry
+        the logs of another block instead of their own.
+    """
+    def __init__(self, **kwargs):
+        super(ForkingChain, self).__init__(**kwargs)
+        self.fork = None
+        self.missing = set()
+        self.moved = {}
+
+    def get_logs(self, log_filter):
+        logs = super(ForkingChain, self).get_logs(log_filter)
+        if self.fork is None or not self.moved:
+            return logs
+        carried = set(self.moved.values())
+        moved = []
+        for evnt in logs:
+            number = int(evnt['blockNumber'], 16)
+            if number in self.moved:
+                index = int(evnt['logIndex'], 16)
+                evnt = dict(make_log(self.moved[number], index), blockNumber=hex(number))
+            elif number > self.fork and number in carried:
+                continue
+            moved.append(evnt)
+        return moved
+
+    def handle(self, request):
+        if request['method'] == 'eth_getBlockByNumber':
+            number = self.block_number(request['params'][0])
+            if number in self.missing:
+                return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': None}
+            if self.fork is not None and number > self.fork:
+                return {'jsonrpc': '2.0', 'id': request.get('id'),
+                        'result': {'number': hex(number), 'hash': '0x%064x' % (number + 2 ** 128)}}
+        return super(ForkingChain, self).handle(request)
+
+
+def make_listener(chain, dedup=None):
+    return ContractListener(contract_config(), chain.url, dedup=dedup,
+                            pipeline=DecodePipeline(processes=1))
+
+
+def test_tracker_rewind():
+    tracker = ReorgTracker(window=10)
+    tracker.set_head(20)
+    for number in range(5, 21):
+        tracker.record_block(number, 'h%s' % number)
+        tracker.record_hashes(number, ['Qm%s' % number])
+
+    # Only the window is kept
+    assert tracker.oldest() == 10
+    assert tracker.recorded()[0] == (20, 'h20')
+
+    assert sorted(tracker.rewind(17)) == ['Qm18', 'Qm19', 'Qm20']
+    assert tracker.recorded()[0] == (17, 'h17')
+    assert tracker.rewind(17) == []
+
+    tracker.set_head(25)
+    assert tracker.oldest() == 15
+    assert 14 not in tracker.queued
+
+
+def test_rewinds_to_fork(start_chain):
+    chain = start_chain(ForkingChain(head=200, logs_per_block=1))
+    dedup = BloomFilter('test', capacity=1000)
+    listener = make_listener(chain, dedup)
+    assert listener.scan() == 201
+    assert listener.queue.qsize() == 201
+    assert not listener.check_reorg()
+
+    chain.fork = 195
+    assert listener.check_reorg()
+    # Hashes from the orphaned blocks come off of the queue
+    assert listener.queue.qsize() == 196
+    assert int(listener.block_number, 16) == 196
+
+    # and go back on when they're scanned again, even though they were seen
+    assert listener.scan() == 5
+    assert listener.queue.qsize() == 201
+    assert not listener.check_reorg()
+
+
+def test_orphaned_hash_mined_after_the_old_head(start_chain):
+    chain = start_chain(ForkingChain(head=200, logs_per_block=1))
+    dedup = BloomFilter('test', capacity=1000)
+    listener = make_listener(chain, dedup)
+    listener.scan()
+    moving = listener.reorg.queued[200]
+
+    # The transaction from block 200 is mined again in block 201
+    chain.fork = 199
+    chain.head = 201
+    chain.moved = {201: 200}
+    assert listener.check_reorg()
+    assert listener.queue.qsize() == 200
+    assert listener.reorg.orphaned.keys() == set(moving)
+
+    listener.scan()
+    assert listener.queue.qsize() == 201
+    assert listener.reorg.queued[201] == moving
+    assert 200 not in listener.reorg.queued
+    assert listener.reorg.orphaned == {}
+
+
+def test_orphaned_hashes_expire():
+    tracker = ReorgTracker(window=10)
+    tracker.set_head(20)
+    tracker.record_hashes(20, ['Qm20'])
+    tracker.rewind(19)
+    assert 'Qm20' in tracker.orphaned
+    tracker.set_head(30)
+    assert 'Qm20' in tracker.orphaned
+    tracker.set_head(31)
+    assert tracker.orphaned == {}
+
+
+def test_rescanned_hashes_are_marked(start_chain):
+    chain = start_chain(ForkingChain(head=200, logs_per_block=1))
+    dedup = BloomFilter('test', capacity=1000)
+    listener = make_listener(chain, dedup)
+    listener.scan()
+    chain.fork = 195
+    listener.check_reorg()
+    # Forget them, as if they had never been marked
+    dedup.clear()
+    listener.scan()
+
+    other = make_listener(chain, dedup)
+    assert other.pin_many(listener.reorg.queued[200]) == []
+
+
+def test_unknown_newest_block_is_not_a_reorg(start_chain):
+    chain = start_chain(ForkingChain(head=200, logs_per_block=1))
+    listener = make_listener(chain)
+    listener.scan()
+
+    chain.missing = {200}
+    assert not listener.check_reorg()
+    assert listener.queue.qsize() == 201
+    assert int(listener.block_number, 16) == 201
+
+
+def test_unknown_block_during_fork_search_is_not_a_reorg(start_chain):
+    chain = start_chain(ForkingChain(head=200, logs_per_block=1))
+    listener = make_listener(chain)
+    listener.scan()
+
+    chain.fork = 195
+    chain.missing = {199}
+    assert not listener.check_reorg()
+    assert listener.queue.qsize() == 201
+
+    # Once the provider catches up the reorg is found
+    chain.missing = set()
+    assert listener.check_reorg()
+    assert listener.queue.qsize() == 196
+
+
+def test_combined_waits_for_most_confirmations(start_chain):
+    chain = start_chain(ForkingChain(head=200, logs_per_block=1))
+    contracts = [contract_config(), contract_config()]
+    contracts[1]['address'] = '0x' + '55' * 20
+    contracts[1]['confirmations'] = 12
+    listener = MultiContractListener(contracts, chain.url, confirmations=3,
+                                     pipeline=DecodePipeline(processes=1))
+    assert listener.confirmations == 12
+    listener.scan()
+    assert int(listener.block_number, 16) == 189
@@ -0,0 +1,109 @@
+import time
+import threading
+import pytest
+from pinner.queue import open_queue, REALTIME, BACKFILL, RETRY
+from pinner.sqlitequeue import SQLiteQueue
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'queue.db')
+
+
+def test_open_queue(path):
+    queue = open_queue('sqlite:' + path, 'test', worker_id='w1')
+    assert isinstance(queue, SQLiteQueue)
+    assert queue.path == path
+
+
+def test_shared_between_connections(path):
+    producer = SQLiteQueue('test', path)
+    worker = SQLiteQueue('test', path, worker_id='w1')
+    producer.append_many(['a', 'b', 'c'])
+    assert worker.pop_many(2) == ['a', 'b']
+    assert worker.in_flight() == 2
+    assert producer.qsize() == 1
+
+    worker.ack('a')
+    assert worker.in_flight() == 1
+    # Queues with other names are separate
+    assert SQLiteQueue('other', path, worker_id='w1').pop() is None
+
+
+def test_fail_retries_then_dead_letters(path):
+    queue = SQLiteQueue('test', path, worker_id='w1', backoff=0, max_attempts=2)
+    queue.append('a', lane=BACKFILL)
+    assert queue.fail(queue.pop())
+    assert queue.retry_size() == 1
+    assert queue.promote_retries() == 1
+    assert queue.qsize(RETRY) == 1
+
+    item = queue.pop()
+    assert queue.attempts([item]) == [1]
+    assert not queue.fail(item)
+    assert queue.dead_size() == 1
+    assert queue.qsize() == 0
+    assert queue.retry_size() == 0
+
+
+def test_reap_keeps_lanes(path):
+    dead = SQLiteQueue('test', path, worker_id='w1', heartbeat_ttl=0.1)
+    alive = SQLiteQueue('test', path, worker_id='w2', heartbeat_ttl=0.1)
+    dead.append('r', lane=REALTIME)
+    dead.append('b', lane=BACKFILL)
+    assert sorted(dead.pop_many(2)) == ['b', 'r']
+
+    time.sleep(0.2)
+    alive.heartbeat()
+    assert alive.reap() == 2
+    assert dead.in_flight() == 0
+    assert alive.lane_sizes() == {REALTIME: 1, BACKFILL: 1, RETRY: 0}
+    # The dead worker is forgotten
+    assert alive.reap() == 0
+
+
+def test_remove_many_only_pending(path):
+    queue = SQLiteQueue('test', path, worker_id='w1')
+    queue.append_many(['a', 'b', 'c'])
+    queue.pop()
+    assert queue.remove_many(['a', 'b']) == 1
+    assert queue.qsize() == 1
+    assert queue.in_flight() == 1
+
+
+def test_pop_without_timeout_does_not_block(path):
+    queue = SQLiteQueue('test', path, worker_id='w1')
+    start = time.time()
+    assert queue.pop() is None
+    assert time.time() - start < 1
+
+
+def test_pop_waits_for_items(path):
+    queue = SQLiteQueue('test', path, worker_id='w1')
+    start = time.time()
+    assert queue.pop(timeout=0.2) is None
+    assert time.time() - start >= 0.2
+
+    producer = SQLiteQueue('test', path)
+    threading.Timer(0.2, producer.append, ['a']).start()
+    assert queue.pop(timeout=5) == 'a'
+
+
+def test_workers_never_share_items(path):
+    SQLiteQueue('test', path).append_many([str(x) for x in range(0, 500)])
+    popped = []
+
+    def work(worker_id):
+        queue = SQLiteQueue('test', path, worker_id=worker_id)
+        while True:
+            items = queue.pop_many(7)
+            if not items:
+                return
+            popped.extend(items)
+
+    threads = [threading.Thread(target=work, args=('w%s' % i,)) for i in range(0, 4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(popped, key=int) == [str(x) for x in range(0, 500)]